@@ -1,16 +1,16 @@
 import os
 import json
-import glob
 import shutil
-import importlib
-import yaml
 import time
+import threading
 from pathlib import Path
 from inspect import signature, Parameter
-from provider import Provider
-from Memories import Memories
-from Extensions import Extensions
-from datetime import datetime
+from provider import get_provider, invalidate_provider
+from Memories import Memories, close_memory_store
+from Embedding import close_embedding_cache
+from Extensions import Extensions, get_extension_commands
+from History import get_history, close_history
+from Browser import get_page_cache
 
 DEFAULT_SETTINGS = {
     "provider": "gpt4free",
@@ -25,7 +25,7 @@ def get_agent_file_paths(agent_name):
     base_path = os.path.join(os.getcwd(), "agents")
     folder_path = os.path.normpath(os.path.join(base_path, agent_name))
     config_path = os.path.normpath(os.path.join(folder_path, "config.json"))
-    history_path = os.path.normpath(os.path.join(folder_path, "history.yaml"))
+    history_path = os.path.normpath(os.path.join(folder_path, "history.jsonl"))
     if not config_path.startswith(base_path) or not folder_path.startswith(base_path):
         raise ValueError("Invalid path, agent name must not contain slashes.")
     if not os.path.exists(folder_path):
@@ -55,11 +55,19 @@ def add_agent(agent_name, provider_settings=None):
         f.write(settings)
     with open(history_path, "w") as f:
         f.write("")
+    close_history(folder_path)
+    invalidate_agent(agent_name)
     return {"message": f"Agent {agent_name} created."}
 
 
 def delete_agent(agent_name):
     config_path, history_path, folder_path = get_agent_file_paths(agent_name=agent_name)
+    if not close_memory_store(agent_name):
+        return {"message": f"Agent {agent_name} is in use, try again later."}, 409
+    close_embedding_cache(agent_name)
+    close_history(folder_path)
+    invalidate_agent(agent_name)
+    get_page_cache().forget_agent(agent_name)
     try:
         if os.path.exists(folder_path):
             shutil.rmtree(folder_path)
@@ -86,7 +94,14 @@ def rename_agent(agent_name, new_name):
                 new_agent_folder = os.path.normpath(os.path.join(base_path, new_name))
             if not new_agent_folder.startswith(base_path):
                 raise ValueError("Invalid path, agent name must not contain slashes.")
+        if not close_memory_store(agent_name):
+            return {"message": f"Agent {agent_name} is in use, try again later."}, 409
+        close_embedding_cache(agent_name)
+        close_history(folder_path)
+        invalidate_agent(agent_name)
+        invalidate_agent(new_name)
         os.rename(folder_path, new_agent_folder)
+        get_page_cache().rename_agent(agent_name, new_name)
         return {"message": f"Agent {agent_name} renamed to {new_name}."}, 200
 
 
@@ -106,6 +121,42 @@ def get_agents():
     return output
 
 
+_agents = {}
+_agents_lock = threading.Lock()
+
+
+def get_agent_config_mtime(agent_name):
+    config_path = os.path.join(os.getcwd(), "agents", agent_name, "config.json")
+    try:
+        return os.stat(config_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_agent(agent_name="AGiXT"):
+    # Agents are reused between requests until their config.json changes on disk
+    mtime = get_agent_config_mtime(agent_name)
+    with _agents_lock:
+        cached = _agents.get(agent_name)
+    if cached is not None and mtime is not None and cached[0] == mtime:
+        return cached[1]
+    agent = Agent(agent_name=agent_name)
+    with _agents_lock:
+        _agents[agent_name] = (get_agent_config_mtime(agent_name), agent)
+    return agent
+
+
+def invalidate_agent(agent_name):
+    with _agents_lock:
+        _agents.pop(agent_name, None)
+
+
+def invalidate_agents():
+    # Cached agents hold their command lists, dropped when extensions are reloaded
+    with _agents_lock:
+        _agents.clear()
+
+
 class Agent:
     def __init__(self, agent_name=None):
         self.agent_name = agent_name if agent_name is not None else "AGiXT"
@@ -117,7 +168,7 @@ class Agent:
             self.PROVIDER_SETTINGS = self.AGENT_CONFIG["settings"]
             if "provider" in self.PROVIDER_SETTINGS:
                 self.AI_PROVIDER = self.PROVIDER_SETTINGS["provider"]
-                self.PROVIDER = Provider(self.AI_PROVIDER, **self.PROVIDER_SETTINGS)
+                self.PROVIDER = get_provider(self.AI_PROVIDER, **self.PROVIDER_SETTINGS)
                 self._load_agent_config_keys(
                     ["AI_MODEL", "AI_TEMPERATURE", "MAX_TOKENS"]
                 )
@@ -147,7 +198,7 @@ class Agent:
                 agent_config=self.AGENT_CONFIG
             ).get_available_commands()
             self.clean_agent_config_commands()
-            self.history = self.load_history()
+            self.history = get_history(self.folder_path)
             self.agent_instances = {}
             self.agent_config = self.load_agent_config()
             if self.LOG_REQUESTS:
@@ -161,17 +212,32 @@ class Agent:
                 ).mkdir(parents=True, exist_ok=True)
 
     def get_memories(self):
-        return Memories(self.agent_name, self.AGENT_CONFIG)
+        return Memories(
+            self.agent_name, self.AGENT_CONFIG, count_tokens=self.PROVIDER.count_tokens
+        )
 
     async def execute(self, command_name, command_args):
-        return await Extensions(agent_config=self.AGENT_CONFIG).execute_command(
-            command_name=command_name, command_args=command_args
-        )
+        return await Extensions(
+            agent_config=self.AGENT_CONFIG, agent_name=self.agent_name
+        ).execute_command(command_name=command_name, command_args=command_args)
 
     async def instruct(self, prompt, tokens):
         if not prompt:
             return ""
         answer = await self.PROVIDER.instruct(prompt=prompt, tokens=tokens)
+        self.log_request(prompt=prompt, answer=answer)
+        return answer
+
+    async def instruct_stream(self, prompt, tokens):
+        if not prompt:
+            return
+        answer = ""
+        async for chunk in self.PROVIDER.instruct_stream(prompt=prompt, tokens=tokens):
+            answer += chunk
+            yield chunk
+        self.log_request(prompt=prompt, answer=answer)
+
+    def log_request(self, prompt, answer):
         if self.LOG_REQUESTS:
             log_file = os.path.join(
                 "agents", self.agent_name, "requests", f"{time.time()}.txt"
@@ -182,7 +248,6 @@ class Agent:
                 encoding="utf-8",
             ) as f:
                 f.write(f"{prompt}\n{answer}")
-        return answer
 
     def _load_agent_config_keys(self, keys):
         for key in keys:
@@ -235,17 +300,10 @@ class Agent:
         return params
 
     def load_commands(self):
-        commands = []
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            module = importlib.import_module(f"extensions.{module_name}")
-            command_class = getattr(module, module_name.lower())()
-            if hasattr(command_class, "commands"):
-                for command_name, command_function in command_class.commands.items():
-                    params = self.get_command_params(command_function)
-                    commands.append((command_name, command_function.__name__, params))
-        return commands
+        return [
+            (command_name, function_name, params)
+            for command_name, _, function_name, params in get_extension_commands()
+        ]
 
     def create_agent_config_file(self, provider_settings, commands):
         if (
@@ -322,6 +380,11 @@ class Agent:
             with open(self.config_path, "r") as f:
                 current_config = json.load(f)
 
+            old_settings = current_config.get("settings", {})
+            if config_key == "settings" and "provider" in old_settings:
+                # Drop the provider instance built from the old settings
+                invalidate_provider(old_settings["provider"], **old_settings)
+
             # Ensure the config_key is present in the current configuration
             if config_key not in current_config:
                 current_config[config_key] = {}
@@ -333,79 +396,61 @@ class Agent:
             # Save the updated configuration back to the file
             with open(self.config_path, "w") as f:
                 json.dump(current_config, f)
+            invalidate_agent(self.agent_name)
             return f"Agent {self.agent_name} configuration updated."
         else:
             return f"Agent {self.agent_name} configuration not found."
 
-    def get_history(self):
-        if not os.path.exists(self.history_file):
-            with open(self.history_file, "w") as f:
-                f.write("")
-            return []
-        try:
-            with open(self.history_file, "r") as f:
-                yaml_history = yaml.safe_load(f)
-            history = []
-            for interaction in yaml_history["interactions"]:
-                role = interaction["role"]
-                message = interaction["timestamp"] + "\n" + interaction["message"]
-                history.append({role: message})
-            return history
-        except:
-            return []
+    def get_history(self, offset: int = 0, limit: int = None):
+        history = []
+        for interaction in self.history.get(offset=offset, limit=limit):
+            role = interaction["role"]
+            message = interaction["timestamp"] + "\n" + interaction["message"]
+            history.append({role: message})
+        return history
+
+    def get_history_messages(self, offset: int = 0, limit: int = None):
+        # Each interaction with its message ID, for deleting single messages
+        return [
+            {
+                "id": interaction["id"],
+                "role": interaction["role"],
+                "message": interaction["message"],
+                "timestamp": interaction["timestamp"],
+            }
+            for interaction in self.history.get(offset=offset, limit=limit)
+        ]
 
     def wipe_agent_memories(self):
-        memories_folder = os.path.normpath(
-            os.path.join(os.getcwd(), self.agent_name, "memories")
-        )
+        memories_folder = os.path.normpath(os.path.join(self.folder_path, "memories"))
         if not memories_folder.startswith(os.getcwd()):
             raise ValueError("Invalid path, agent name must not contain slashes.")
 
+        if not close_memory_store(self.agent_name):
+            return False
+        get_page_cache().forget_agent(self.agent_name)
         if os.path.exists(memories_folder):
             shutil.rmtree(memories_folder)
-
-    def load_history(self):
-        if os.path.exists(self.history_file):
-            with open(self.history_file, "r") as file:
-                memory = yaml.safe_load(file)
-        else:
-            with open(self.history_file, "w") as file:
-                yaml.safe_dump({"interactions": []}, file)
-            memory = {"interactions": []}
-        return memory
-
-    def save_history(self):
-        with open(self.history_file, "w") as file:
-            yaml.safe_dump(self.history, file)
+        return True
 
     def log_interaction(self, role: str, message: str):
-        if self.history is None:
-            self.history = {"interactions": []}
-        self.history["interactions"].append(
-            {
-                "role": role,
-                "message": message,
-                "timestamp": datetime.now().strftime("%B %d, %Y %I:%M %p"),
-            }
-        )
-        self.save_history()
+        self.history.append(role=role, message=message)
 
     def delete_history(self):
         try:
-            self.history = {"interactions": []}
-            self.save_history()
+            self.history.clear()
             return "History deleted."
         except:
             return "History not found."
 
     def delete_history_message(self, message: str):
         try:
-            self.history["interactions"] = [
-                interaction
-                for interaction in self.history["interactions"]
-                if interaction["message"] != message
-            ]
-            self.save_history()
+            self.history.delete_message(message)
             return "Message deleted."
         except:
             return "Message not found."
+
+    def delete_history_message_by_id(self, message_id: str):
+        if self.history.delete(message_id):
+            return "Message deleted."
+        return "Message not found."
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import weakref
+import logging
+import threading
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from bs4 import BeautifulSoup
+from playwright.async_api import async_playwright
+from HttpClient import get_session
+
+BROWSER_MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", 4))
+BROWSER_PAGE_TIMEOUT = float(os.getenv("BROWSER_PAGE_TIMEOUT", 30))
+BLOCKED_RESOURCES = ["image", "font", "media"]
+LINKS_SCRIPT = "links => links.map(link => [link.textContent, link.href])"
+PAGE_CACHE_PATH = os.getenv(
+    "PAGE_CACHE_PATH", os.path.join(os.getcwd(), "page_cache.db")
+)
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", 86400))
+_pools = weakref.WeakKeyDictionary()
+
+
+def normalize_url(url: str):
+    # Maps the many spellings of one page to a single key: lowercase scheme and
+    # host, no default port, fragment or trailing slash, sorted query
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in [("http", 80), ("https", 443)]:
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/") or "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+async def block_resources(route):
+    # Text extraction doesn't need images, fonts or media
+    if route.request.resource_type in BLOCKED_RESOURCES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+class BrowserPool:
+    # One headless Chromium shared by every scrape, each page gets its own
+    # context and at most max_pages are open at once
+    def __init__(
+        self, max_pages: int = BROWSER_MAX_PAGES, timeout: float = BROWSER_PAGE_TIMEOUT
+    ):
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_pages)
+        self.lock = asyncio.Lock()
+        self.playwright = None
+        self.browser = None
+
+    async def get_browser(self):
+        async with self.lock:
+            if self.browser is None or not self.browser.is_connected():
+                if self.playwright is None:
+                    self.playwright = await async_playwright().start()
+                self.browser = await self.playwright.chromium.launch()
+            return self.browser
+
+    @asynccontextmanager
+    async def page(self, text_only: bool = True):
+        async with self.semaphore:
+            browser = await self.get_browser()
+            context = await browser.new_context()
+            try:
+                context.set_default_timeout(self.timeout * 1000)
+                if text_only:
+                    await context.route("**/*", block_resources)
+                yield await context.new_page()
+            finally:
+                await context.close()
+
+    async def fetch(self, url: str):
+        # Returns the rendered HTML, every (title, href) link on the page and the
+        # response headers
+        async with self.page() as page:
+            response = await page.goto(url)
+            content = await page.content()
+            links = await page.eval_on_selector_all("a", LINKS_SCRIPT)
+        headers = response.headers if response is not None else {}
+        return content, [(title, href) for title, href in links], headers
+
+    async def close(self):
+        async with self.lock:
+            try:
+                if self.browser is not None:
+                    await self.browser.close()
+                if self.playwright is not None:
+                    await self.playwright.stop()
+            except Exception as e:
+                logging.info(f"Unable to close browser: {e}")
+            self.browser = None
+            self.playwright = None
+
+
+def get_browser_pool():
+    # Playwright objects are bound to the event loop that created them
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = BrowserPool()
+        _pools[loop] = pool
+    return pool
+
+
+async def close_browser_pool():
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+class PageCache:
+    # Extracted text and links of fetched pages keyed by normalized URL.
+    # checked_at drives the TTL, fetched_at changes only when the content does.
+    def __init__(self, db_path: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages "
+            "(url TEXT PRIMARY KEY, text TEXT, links TEXT, fetched_at REAL, "
+            "checked_at REAL, etag TEXT, last_modified TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ingested "
+            "(url TEXT, agent_name TEXT, fetched_at REAL, "
+            "PRIMARY KEY (url, agent_name))"
+        )
+        self.connection.commit()
+
+    def get(self, url: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT url, text, links, fetched_at, checked_at, etag, last_modified "
+                "FROM pages WHERE url = ?",
+                [url],
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "url": row[0],
+            "text": row[1],
+            "links": [tuple(link) for link in json.loads(row[2])],
+            "fetched_at": row[3],
+            "checked_at": row[4],
+            "etag": row[5],
+            "last_modified": row[6],
+        }
+
+    def put(self, url: str, text: str, links, etag=None, last_modified=None):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [url, text, json.dumps(links), now, now, etag, last_modified],
+            )
+            self.connection.commit()
+        return self.get(url)
+
+    def touch(self, url: str):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE pages SET checked_at = ? WHERE url = ?", [time.time(), url]
+            )
+            self.connection.commit()
+        return self.get(url)
+
+    def is_ingested(self, page, agent_name: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT fetched_at FROM ingested WHERE url = ? AND agent_name = ?",
+                [page["url"], agent_name],
+            ).fetchone()
+        return row is not None and row[0] == page["fetched_at"]
+
+    def mark_ingested(self, page, agent_name: str):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO ingested VALUES (?, ?, ?)",
+                [page["url"], agent_name, page["fetched_at"]],
+            )
+            self.connection.commit()
+
+    def forget_agent(self, agent_name: str):
+        # Called when an agent's memories are wiped so its pages are learned again
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM ingested WHERE agent_name = ?", [agent_name]
+            )
+            self.connection.commit()
+
+    def rename_agent(self, agent_name: str, new_name: str):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM ingested WHERE agent_name = ?", [new_name]
+            )
+            self.connection.execute(
+                "UPDATE ingested SET agent_name = ? WHERE agent_name = ?",
+                [new_name, agent_name],
+            )
+            self.connection.commit()
+
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+
+def get_page_cache():
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache(PAGE_CACHE_PATH)
+        return _page_cache
+
+
+async def is_unchanged(url: str, page):
+    # Conditional request against the ETag or Last-Modified seen last time
+    headers = {}
+    if page["etag"]:
+        headers["If-None-Match"] = page["etag"]
+    if page["last_modified"]:
+        headers["If-Modified-Since"] = page["last_modified"]
+    if not headers:
+        return False
+    try:
+        async with get_session().get(url, headers=headers) as response:
+            return response.status == 304
+    except Exception:
+        return False
+
+
+async def read_page(url: str):
+    # Returns the cached page while it is fresh or the server says it hasn't
+    # changed, otherwise renders it in the browser pool and caches the result
+    cache = get_page_cache()
+    key = normalize_url(url)
+    page = cache.get(key)
+    if page is not None:
+        if time.time() - page["checked_at"] < PAGE_CACHE_TTL:
+            return page
+        if await is_unchanged(url, page):
+            return cache.touch(key)
+    content, links, headers = await get_browser_pool().fetch(url)
+    text = " ".join(BeautifulSoup(content, "html.parser").get_text().split())
+    return cache.put(
+        key,
+        text,
+        links,
+        etag=headers.get("etag"),
+        last_modified=headers.get("last-modified"),
+    )
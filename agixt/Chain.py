@@ -252,7 +252,7 @@ class Chain:
                 )
                 if prompt_type == "Command":
                     return await Extensions(
-                        agent_config=agent.agent.agent_config
+                        agent_config=agent.agent.agent_config, agent_name=agent_name
                     ).execute_command(
                         command_name=args["command_name"], command_args=args
                     )
@@ -1,5 +1,13 @@
 import requests
 import inspect
+import asyncio
+import os
+import sqlite3
+import threading
+import numpy as np
+from typing import List
+from collections import OrderedDict
+from hashlib import sha256
 from chromadb.utils import embedding_functions
 from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
 from semantic_kernel.connectors.ai.hugging_face import HuggingFaceTextEmbedding
@@ -57,106 +65,296 @@ class GoogleVertexEmbeddingFunction(EmbeddingFunction):
         self._session.headers.update({"Authorization": f"Bearer {api_key}"})
 
     def __call__(self, texts: Documents) -> Embeddings:
-        response = self._session.post(
-            self._api_url, json={"instances": [{"content": texts}]}
-        ).json()
-
-        if "predictions" in response:
-            return response["predictions"]
-        return {}
+        embeddings = []
+        # Vertex AI accepts up to 5 instances per prediction request
+        for i in range(0, len(texts), 5):
+            response = self._session.post(
+                self._api_url,
+                json={"instances": [{"content": text} for text in texts[i : i + 5]]},
+            ).json()
+            if "predictions" not in response:
+                return []
+            embeddings.extend(
+                prediction["embeddings"]["values"]
+                for prediction in response["predictions"]
+            )
+        return embeddings
 
 
 class LlamacppEmbeddingFunction(EmbeddingFunction):
     def __init__(self, api_host: str):
-        self._api_host = api_host
+        self._api_url = f"{api_host.rstrip('/')}/v1/embeddings"
         self._session = requests.Session()
 
     def __call__(self, texts: Documents) -> Embeddings:
-        response = self._session.post(
-            self._api_url, json={"content": texts, "threads": 5}
-        ).json()
+        response = self._session.post(self._api_url, json={"input": texts}).json()
         if "data" in response:
-            if "embedding" in response["data"]:
-                return response["data"]["embedding"]
-        return {}
+            return [item["embedding"] for item in response["data"]]
+        return []
+
+
+EMBEDDER_CACHE_SIZE = int(os.getenv("EMBEDDER_CACHE_SIZE", 4))
+_embedders = OrderedDict()
+_embedders_lock = threading.Lock()
+
+
+def get_cached_embedder(key, factory):
+    # Embedders hold model weights or HTTP sessions, keep them warm across calls.
+    key = sha256(repr(key).encode()).hexdigest()
+    with _embedders_lock:
+        if key in _embedders:
+            _embedders.move_to_end(key)
+            return _embedders[key]
+        embedder = factory()
+        _embedders[key] = embedder
+        while len(_embedders) > EMBEDDER_CACHE_SIZE:
+            _embedders.popitem(last=False)
+        return embedder
+
+
+async def warm_embedders(agent_configs=[]):
+    warmed = []
+    for agent_config in agent_configs or [None]:
+        try:
+            embedder = agent_config["settings"]["embedder"]
+        except:
+            embedder = "default"
+        if embedder in warmed:
+            continue
+        try:
+            await Embedding(AGENT_CONFIG=agent_config).get_embedder()
+            warmed.append(embedder)
+        except Exception as e:
+            logging.info(f"Unable to warm up embedder {embedder}: {e}")
+    return warmed
+
+
+class EmbeddingCache:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(embedder TEXT, text_hash TEXT, embedding BLOB, "
+            "PRIMARY KEY (embedder, text_hash))"
+        )
+        self.connection.commit()
+
+    def get_many(self, embedder: str, text_hashes: List[str]):
+        found = {}
+        unique_hashes = list(set(text_hashes))
+        with self.lock:
+            for i in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[i : i + 500]
+                rows = self.connection.execute(
+                    "SELECT text_hash, embedding FROM embeddings WHERE embedder = ? "
+                    f"AND text_hash IN ({','.join('?' * len(batch))})",
+                    [embedder, *batch],
+                ).fetchall()
+                for text_hash, embedding in rows:
+                    found[text_hash] = np.frombuffer(embedding, dtype=np.float32)
+            for text_hash in text_hashes:
+                if text_hash in found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def put_many(self, embedder: str, embeddings: dict):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [
+                    (embedder, text_hash, np.asarray(embedding, np.float32).tobytes())
+                    for text_hash, embedding in embeddings.items()
+                ],
+            )
+            self.connection.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_embedding_caches = {}
+_embedding_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(agent_name: str):
+    base_path = os.path.join(os.getcwd(), "agents")
+    folder_path = os.path.normpath(os.path.join(base_path, agent_name))
+    if not folder_path.startswith(base_path):
+        raise ValueError("Invalid path, agent name must not contain slashes.")
+    with _embedding_caches_lock:
+        if folder_path not in _embedding_caches:
+            os.makedirs(folder_path, exist_ok=True)
+            _embedding_caches[folder_path] = EmbeddingCache(
+                os.path.join(folder_path, "embeddings.db")
+            )
+        return _embedding_caches[folder_path]
+
+
+def close_embedding_cache(agent_name: str):
+    # Closed before the agent folder is deleted or renamed
+    folder_path = os.path.normpath(os.path.join(os.getcwd(), "agents", agent_name))
+    with _embedding_caches_lock:
+        cache = _embedding_caches.pop(folder_path, None)
+    if cache is not None:
+        cache.close()
 
 
 class Embedding:
-    def __init__(self, AGENT_CONFIG=None):
+    def __init__(self, AGENT_CONFIG=None, agent_name: str = None):
         self.AGENT_CONFIG = AGENT_CONFIG
+        self.agent_name = agent_name
+        self.embedder_name = "default"
+        try:
+            self.batch_size = int(AGENT_CONFIG["settings"]["EMBEDDING_BATCH_SIZE"])
+        except:
+            self.batch_size = 32
 
     async def get_embedder(self):
         try:
             embedder = self.AGENT_CONFIG["settings"]["embedder"]
             embed, chunk_size = await self.__getattribute__(embedder)()
+            self.embedder_name = embedder
         except:
             embed, chunk_size = await self.default()
+            self.embedder_name = "default"
             logging.info("Embedder not found, using default embedder")
         return embed, chunk_size
 
     async def embed_text(self, text):
+        embeddings = await self.embed_batch([text])
+        return embeddings[0]
+
+    async def embed_batch(self, texts: List[str], batch_size: int = None):
         embed, chunk_size = await self.get_embedder()
-        return await embed(text)
+        if self.agent_name is None:
+            return await self._embed_batch(embed, texts, batch_size)
+        cache = get_embedding_cache(self.agent_name)
+        text_hashes = [sha256(text.encode()).hexdigest() for text in texts]
+        cached = cache.get_many(self.embedder_name, text_hashes)
+        missing = {}
+        for text_hash, text in zip(text_hashes, texts):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+        if missing:
+            embeddings = await self._embed_batch(
+                embed, list(missing.values()), batch_size
+            )
+            new_embeddings = dict(zip(missing.keys(), embeddings))
+            cache.put_many(self.embedder_name, new_embeddings)
+            cached.update(new_embeddings)
+        return [cached[text_hash] for text_hash in text_hashes]
+
+    async def _embed_batch(self, embed, texts: List[str], batch_size: int = None):
+        batch_size = int(batch_size or self.batch_size)
+        embeddings = []
+        for i in range(0, len(texts), batch_size):
+            batch = texts[i : i + batch_size]
+            if inspect.iscoroutinefunction(embed):
+                vectors = await embed(batch)
+            else:
+                # Chroma embedding functions are synchronous
+                vectors = await asyncio.to_thread(embed, batch)
+            if len(vectors) != len(batch):
+                raise RuntimeError(
+                    f"Embedder returned {len(vectors)} embeddings for {len(batch)} texts."
+                )
+            embeddings.extend(np.array(vector) for vector in vectors)
+        return embeddings
 
     async def default(self):
         chunk_size = 128
-        embed = HuggingFaceTextEmbedding(
-            model_id="all-mpnet-base-v2", log=logging
+        embed = get_cached_embedder(
+            ("default", "all-mpnet-base-v2"),
+            lambda: HuggingFaceTextEmbedding(model_id="all-mpnet-base-v2", log=logging),
         ).generate_embeddings_async
         return embed, chunk_size
 
     async def large_local(self):
         chunk_size = 500
-        embed = HuggingFaceTextEmbedding(
-            model_id="gtr-t5-large", log=logging
+        embed = get_cached_embedder(
+            ("large_local", "gtr-t5-large"),
+            lambda: HuggingFaceTextEmbedding(model_id="gtr-t5-large", log=logging),
         ).generate_embeddings_async
         return embed, chunk_size
 
     async def azure(self):
         chunk_size = 1000
-        embed = AzureTextEmbedding(
-            deployment_name=self.AGENT_CONFIG["settings"]["AZURE_DEPLOYMENT_NAME"],
-            endpoint=self.AGENT_CONFIG["settings"]["AZURE_OPENAI_ENDPOINT"],
-            api_key=self.AGENT_CONFIG["settings"]["AZURE_API_KEY"],
-            logger=logging,
+        settings = self.AGENT_CONFIG["settings"]
+        embed = get_cached_embedder(
+            (
+                "azure",
+                settings["AZURE_DEPLOYMENT_NAME"],
+                settings["AZURE_OPENAI_ENDPOINT"],
+                settings["AZURE_API_KEY"],
+            ),
+            lambda: AzureTextEmbedding(
+                deployment_name=settings["AZURE_DEPLOYMENT_NAME"],
+                endpoint=settings["AZURE_OPENAI_ENDPOINT"],
+                api_key=settings["AZURE_API_KEY"],
+                logger=logging,
+            ),
         ).generate_embeddings_async
         return embed, chunk_size
 
     async def openai(self):
         chunk_size = 1000
-        embed = OpenAITextEmbedding(
-            model_id="text-embedding-ada-002",
-            api_key=self.AGENT_CONFIG["settings"]["OPENAI_API_KEY"],
-            log=logging,
+        api_key = self.AGENT_CONFIG["settings"]["OPENAI_API_KEY"]
+        embed = get_cached_embedder(
+            ("openai", "text-embedding-ada-002", api_key),
+            lambda: OpenAITextEmbedding(
+                model_id="text-embedding-ada-002",
+                api_key=api_key,
+                log=logging,
+            ),
         ).generate_embeddings_async
         return embed, chunk_size
 
     async def google_palm(self):
         chunk_size = 1000
-        embed = GooglePalmEmbeddingFunction(
-            api_key=self.AGENT_CONFIG["settings"]["GOOGLE_API_KEY"],
+        api_key = self.AGENT_CONFIG["settings"]["GOOGLE_API_KEY"]
+        embed = get_cached_embedder(
+            ("google_palm", api_key),
+            lambda: GooglePalmEmbeddingFunction(api_key=api_key),
         )
         return embed, chunk_size
 
     async def google_vertex(self):
         chunk_size = 1000
-        embed = GoogleVertexEmbeddingFunction(
-            api_key=self.AGENT_CONFIG["settings"]["GOOGLE_API_KEY"],
-            project_id=self.AGENT_CONFIG["settings"]["GOOGLE_PROJECT_ID"],
+        api_key = self.AGENT_CONFIG["settings"]["GOOGLE_API_KEY"]
+        project_id = self.AGENT_CONFIG["settings"]["GOOGLE_PROJECT_ID"]
+        embed = get_cached_embedder(
+            ("google_vertex", api_key, project_id),
+            lambda: GoogleVertexEmbeddingFunction(
+                api_key=api_key, project_id=project_id
+            ),
         )
         return embed, chunk_size
 
     async def cohere(self):
         chunk_size = 500
-        embed = embedding_functions.CohereEmbeddingFunction(
-            api_key=self.AGENT_CONFIG["settings"]["COHERE_API_KEY"],
+        api_key = self.AGENT_CONFIG["settings"]["COHERE_API_KEY"]
+        embed = get_cached_embedder(
+            ("cohere", api_key),
+            lambda: embedding_functions.CohereEmbeddingFunction(api_key=api_key),
         )
         return embed, chunk_size
 
     async def llamacpp(self):
         chunk_size = 250
-        embed = LlamacppEmbeddingFunction(
-            model_name=self.AGENT_CONFIG["settings"]["EMBEDDING_URI"],
+        api_host = self.AGENT_CONFIG["settings"]["EMBEDDING_URI"]
+        embed = get_cached_embedder(
+            ("llamacpp", api_host),
+            lambda: LlamacppEmbeddingFunction(api_host=api_host),
         )
         return embed, chunk_size
 
@@ -165,5 +363,6 @@ def get_embedding_providers():
     return [
         func
         for func, _ in inspect.getmembers(Embedding, predicate=inspect.isfunction)
-        if not func.startswith("__")
+        if not func.startswith("_")
+        and func not in ["get_embedder", "embed_text", "embed_batch"]
     ]
@@ -1,13 +1,348 @@
 import importlib
 import os
+import ast
+import sys
+import json
 import glob
+import time
+import threading
+from hashlib import sha256
 from inspect import signature, Parameter
 import logging
 
+EXTENSION_IMPORT_REPORT = os.getenv("EXTENSION_IMPORT_REPORT", "false").lower() in [
+    "true",
+    "1",
+]
+_extensions = {}
+_extension_commands = {}
+_extension_classes = {}
+_import_times = {}
+_extension_instances = {}
+_extensions_lock = threading.Lock()
+
+
+def scan_extension(source: str, class_name: str):
+    # Reads an extension's settings and the commands it registers in __init__
+    # without importing it. Each command keeps the if conditions it was
+    # registered under, so they can be checked against an agent's settings later.
+    for node in ast.parse(source).body:
+        if not isinstance(node, ast.ClassDef) or node.name != class_name:
+            continue
+        if not any(
+            isinstance(base, ast.Name) and base.id == "Extensions"
+            for base in node.bases
+        ):
+            return None
+        methods = {
+            item.name: item
+            for item in node.body
+            if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef))
+        }
+        commands = []
+        dynamic = False
+        settings = {}
+        if "__init__" in methods:
+            dynamic = _scan_commands(methods["__init__"].body, [], commands)
+            settings = _scan_params(methods["__init__"])
+        return {
+            "settings": settings,
+            "commands": [
+                (
+                    command_name,
+                    function_name,
+                    _scan_params(methods[function_name])
+                    if function_name in methods
+                    else None,
+                    conditions,
+                )
+                for command_name, function_name, conditions in commands
+            ],
+            "dynamic": dynamic,
+        }
+    return None
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except Exception:
+        return None
+
+
+def _scan_params(function):
+    # Same shape as get_function_params, read from the function definition
+    args = function.args
+    positional = args.posonlyargs + args.args
+    defaults = [None] * (len(positional) - len(args.defaults)) + [
+        _literal(default) for default in args.defaults
+    ]
+    params = {}
+    for arg, default in zip(positional, defaults):
+        params[arg.arg] = default
+    for arg, default in zip(args.kwonlyargs, args.kw_defaults):
+        params[arg.arg] = _literal(default) if default is not None else None
+    params.pop("self", None)
+    params.pop("kwargs", None)
+    return params
+
+
+def _is_self_attribute(node, attr=None):
+    return (
+        isinstance(node, ast.Attribute)
+        and isinstance(node.value, ast.Name)
+        and node.value.id == "self"
+        and (attr is None or node.attr == attr)
+    )
+
+
+def _scan_dict(node, conditions, commands):
+    dynamic = False
+    for key, value in zip(node.keys, node.values):
+        if (
+            isinstance(key, ast.Constant)
+            and isinstance(key.value, str)
+            and _is_self_attribute(value)
+        ):
+            commands.append((key.value, value.attr, conditions))
+        else:
+            dynamic = True
+    return dynamic
+
+
+def _scan_commands(body, conditions, commands):
+    dynamic = False
+    for node in body:
+        if isinstance(node, ast.If):
+            dynamic |= _scan_commands(node.body, conditions + [node.test], commands)
+            dynamic |= _scan_commands(
+                node.orelse, conditions + [ast.UnaryOp(ast.Not(), node.test)], commands
+            )
+        elif isinstance(node, (ast.For, ast.While, ast.With, ast.Try)):
+            # Commands registered in loops or blocks are only known at runtime
+            if any(_is_self_attribute(child, "commands") for child in ast.walk(node)):
+                dynamic = True
+        elif isinstance(node, ast.Assign):
+            target = node.targets[0]
+            if _is_self_attribute(target, "commands"):
+                if isinstance(node.value, ast.Dict):
+                    dynamic |= _scan_dict(node.value, conditions, commands)
+                else:
+                    dynamic = True
+            elif isinstance(target, ast.Subscript) and _is_self_attribute(
+                target.value, "commands"
+            ):
+                key = target.slice
+                if (
+                    isinstance(key, ast.Constant)
+                    and isinstance(key.value, str)
+                    and _is_self_attribute(node.value)
+                ):
+                    commands.append((key.value, node.value.attr, conditions))
+                else:
+                    dynamic = True
+        elif (
+            isinstance(node, ast.Expr)
+            and isinstance(node.value, ast.Call)
+            and isinstance(node.value.func, ast.Attribute)
+            and _is_self_attribute(node.value.func.value, "commands")
+        ):
+            call = node.value
+            if call.func.attr == "update" and isinstance(call.args[0], ast.Dict):
+                dynamic |= _scan_dict(call.args[0], conditions, commands)
+            else:
+                dynamic = True
+    return dynamic
+
+
+def _evaluate(node, settings):
+    # Just enough of Python to read conditions like `if self.API_KEY:`
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        return settings[node.id]
+    if _is_self_attribute(node):
+        return settings[node.attr]
+    if isinstance(node, ast.BoolOp):
+        values = [_evaluate(value, settings) for value in node.values]
+        return all(values) if isinstance(node.op, ast.And) else any(values)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return not _evaluate(node.operand, settings)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        left = _evaluate(node.left, settings)
+        right = _evaluate(node.comparators[0], settings)
+        op = node.ops[0]
+        if isinstance(op, ast.Eq):
+            return left == right
+        if isinstance(op, ast.NotEq):
+            return left != right
+        if isinstance(op, ast.Is):
+            return left is right
+        if isinstance(op, ast.IsNot):
+            return left is not right
+    raise ValueError(f"Unsupported condition: {ast.unparse(node)}")
+
+
+def condition_met(conditions, settings):
+    for condition in conditions:
+        try:
+            if not _evaluate(condition, settings):
+                return False
+        except Exception:
+            # Conditions that can't be read statically are left to the extension
+            pass
+    return True
+
+
+def get_function_params(func):
+    params = {}
+    for name, param in signature(func).parameters.items():
+        if name == "self" or name == "kwargs":
+            continue
+        if param.default == Parameter.empty:
+            params[name] = None
+        else:
+            params[name] = param.default
+    return params
+
+
+def get_extension_class(module_name: str):
+    # Extension modules are only imported once one of their commands is needed
+    if module_name not in _extension_classes:
+        start = time.perf_counter()
+        module = importlib.import_module(f"extensions.{module_name}")
+        _import_times[module_name] = time.perf_counter() - start
+        _extension_classes[module_name] = getattr(module, module_name)
+    return _extension_classes[module_name]
+
+
+def get_import_report():
+    return dict(sorted(_import_times.items(), key=lambda item: -item[1]))
+
+
+def report_import_costs():
+    # Imports every extension to measure it, so it is opt in with
+    # EXTENSION_IMPORT_REPORT. Modules shared between extensions are only
+    # counted against the first one that imports them.
+    for module_name in load_extensions():
+        try:
+            get_extension_class(module_name)
+        except Exception as e:
+            logging.info(f"Unable to import extension {module_name}: {e}")
+    for module_name, seconds in get_import_report().items():
+        logging.info(f"Extension {module_name} import took {seconds * 1000:.1f}ms")
+    return get_import_report()
+
+
+def load_extensions(reload: bool = False):
+    # Process-wide registry of extensions, built once and shared by every agent
+    with _extensions_lock:
+        if _extensions and not reload:
+            return _extensions
+        if reload:
+            for module_name in _extension_classes:
+                sys.modules.pop(f"extensions.{module_name}", None)
+            _extension_classes.clear()
+        extensions = {}
+        extension_commands = {}
+        for command_file in sorted(glob.glob("extensions/*.py")):
+            module_name = os.path.splitext(os.path.basename(command_file))[0]
+            try:
+                with open(command_file, "r", encoding="utf-8") as f:
+                    extension = scan_extension(f.read(), module_name)
+            except Exception as e:
+                logging.info(f"Unable to load extension {module_name}: {e}")
+                continue
+            if extension is None:
+                continue
+            for command_name, function_name, params, _ in extension["commands"]:
+                extension_commands[command_name] = (module_name, function_name, params)
+            extensions[module_name] = extension
+        _extensions.clear()
+        _extensions.update(extensions)
+        _extension_commands.clear()
+        _extension_commands.update(extension_commands)
+        logging.debug(f"Loaded extensions: {list(extensions)}")
+        return _extensions
+
+
+def reload_extensions():
+    return load_extensions(reload=True)
+
+
+def get_extension_commands(settings: dict = {}):
+    commands = []
+    for module_name, extension in load_extensions().items():
+        if extension["dynamic"]:
+            # Command names built at runtime need a real instance to be listed
+            try:
+                command_class = get_extension_class(module_name)(**settings)
+            except Exception as e:
+                logging.info(f"Unable to load {module_name}: {e}")
+                continue
+            for command_name, command_function in getattr(
+                command_class, "commands", {}
+            ).items():
+                commands.append(
+                    (
+                        command_name,
+                        module_name,
+                        command_function.__name__,
+                        get_function_params(command_function),
+                    )
+                )
+            continue
+        extension_settings = {**extension["settings"], **settings}
+        for command_name, function_name, params, conditions in extension["commands"]:
+            if condition_met(conditions, extension_settings):
+                commands.append((command_name, module_name, function_name, params))
+    return commands
+
+
+async def get_extension_instance(
+    module_name: str, settings: dict = {}, agent_name: str = None
+):
+    # One instance per agent and extension, rebuilt when the settings change
+    settings_hash = sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    key = (agent_name, module_name)
+    cached = _extension_instances.get(key)
+    if cached is not None and cached[0] == settings_hash:
+        return cached[1]
+    instance = get_extension_class(module_name)(**settings)
+    await instance.startup()
+    cached = _extension_instances.get(key)
+    if cached is not None and cached[0] == settings_hash:
+        # Another request built it first
+        await shutdown_extension(instance)
+        return cached[1]
+    _extension_instances[key] = (settings_hash, instance)
+    if cached is not None:
+        await shutdown_extension(cached[1])
+    return instance
+
+
+async def shutdown_extension(instance):
+    try:
+        await instance.shutdown()
+    except Exception as e:
+        logging.info(f"Unable to shut down {instance.__class__.__name__}: {e}")
+
+
+async def shutdown_extensions(agent_name: str = None):
+    for key in list(_extension_instances):
+        if agent_name is None or key[0] == agent_name:
+            _, instance = _extension_instances.pop(key)
+            await shutdown_extension(instance)
+
 
 class Extensions:
-    def __init__(self, agent_config=None, load_commands_flag: bool = True):
+    def __init__(
+        self, agent_config=None, load_commands_flag: bool = True, agent_name=None
+    ):
         self.agent_config = agent_config
+        self.agent_name = agent_name
         if load_commands_flag:
             self.commands = self.load_commands()
         else:
@@ -56,72 +391,40 @@ class Extensions:
             settings = self.agent_config["settings"]
         except:
             settings = {}
-        commands = []
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            module = importlib.import_module(f"extensions.{module_name}")
-            if issubclass(getattr(module, module_name), Extensions):
-                command_class = getattr(module, module_name)(**settings)
-                if hasattr(command_class, "commands"):
-                    for (
-                        command_name,
-                        command_function,
-                    ) in command_class.commands.items():
-                        params = self.get_command_params(command_function)
-                        # Store the module along with the function name
-                        commands.append(
-                            (
-                                command_name,
-                                getattr(module, module_name),
-                                command_function.__name__,
-                                params,
-                            )
-                        )
-        # Return the commands list
+        commands = get_extension_commands(settings)
+        self.command_index = {
+            command_name: (module_name, function_name, params)
+            for command_name, module_name, function_name, params in commands
+        }
         logging.debug(f"loaded commands: {commands}")
         return commands
 
     def get_extension_settings(self):
         settings = {}
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            module = importlib.import_module(f"extensions.{module_name}")
-            if issubclass(getattr(module, module_name), Extensions):
-                command_class = getattr(module, module_name)()
-                params = self.get_command_params(command_class.__init__)
-                # Remove self and kwargs from params
-                if "self" in params:
-                    del params["self"]
-                if "kwargs" in params:
-                    del params["kwargs"]
-                if params != {}:
-                    settings[module_name] = params
+        for module_name, extension in load_extensions().items():
+            if extension["settings"] != {}:
+                settings[module_name] = extension["settings"]
         return settings
 
     def get_command_params(self, func):
-        params = {}
-        sig = signature(func)
-        for name, param in sig.parameters.items():
-            if name == "self":
-                continue
-            if param.default == Parameter.empty:
-                params[name] = None
-            else:
-                params[name] = param.default
-        return params
+        return get_function_params(func)
 
     def find_command(self, command_name: str):
-        for name, module, function_name, params in self.commands:
-            if name == command_name:
-                command_function = getattr(module, function_name)
-                return command_function, module, params  # Updated return statement
-        return None, None, None  # Updated return statement
+        command = getattr(self, "command_index", {}).get(command_name)
+        if command is None:
+            command = _extension_commands.get(command_name)
+        if command is None:
+            return None, None, None
+        module_name, function_name, params = command
+        command_class = get_extension_class(module_name)
+        if params is None:
+            # Inherited commands aren't visible to the scan
+            params = get_function_params(getattr(command_class, function_name))
+        return getattr(command_class, function_name), command_class, params
 
     def get_commands_list(self):
         self.commands = self.load_commands()
-        commands_list = [command_name for command_name, _, _ in self.commands]
+        commands_list = [command_name for command_name, _, _, _ in self.commands]
         return commands_list
 
     async def execute_command(self, command_name: str, command_args: dict = None):
@@ -141,21 +444,33 @@ class Extensions:
             if param not in params:
                 del args[param]
         try:
-            output = await getattr(module(), command_function.__name__)(**args)
+            settings = self.agent_config["settings"]
+        except:
+            settings = {}
+        try:
+            instance = await get_extension_instance(
+                # Extension classes are named after their module
+                module_name=module.__name__,
+                settings=settings,
+                agent_name=self.agent_name,
+            )
+            output = await getattr(instance, command_function.__name__)(**args)
         except Exception as e:
             output = f"Error: {str(e)}"
         logging.info(f"Command Output: {output}")
         return output
 
+    async def startup(self):
+        # Called once after an extension instance is created, before any command
+        # runs on it. Override to open sessions or clients the commands reuse.
+        pass
+
+    async def shutdown(self):
+        # Called when the instance is replaced or the server stops
+        pass
+
     def get_extensions(self):
-        commands = []
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            module = importlib.import_module(f"extensions.{module_name}")
-            command_class = getattr(module, module_name.lower())()
-            if hasattr(command_class, "commands"):
-                for command_name, command_function in command_class.commands.items():
-                    params = self.get_command_params(command_function)
-                    commands.append((command_name, command_function.__name__, params))
-        return commands
+        return [
+            (command_name, function_name, params)
+            for command_name, _, function_name, params in get_extension_commands()
+        ]
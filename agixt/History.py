@@ -0,0 +1,204 @@
+import os
+import json
+import yaml
+import logging
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from uuid import uuid4
+
+HISTORY_COMPACT_THRESHOLD = int(os.getenv("HISTORY_COMPACT_THRESHOLD", 100))
+
+
+class History:
+    # Append-only JSON Lines log of an agent's conversation. Each line is one
+    # interaction in the order it happened, offsets holds the byte position of
+    # every live line so pages can be read without parsing the whole file.
+    # Deleting appends a tombstone line, the file is compacted once enough
+    # tombstones pile up.
+    def __init__(self, folder_path: str):
+        self.file_path = os.path.join(folder_path, "history.jsonl")
+        self.lock = threading.Lock()
+        self.offsets = []
+        self.ids = {}
+        self.tombstones = 0
+        self.stamp = None
+        self.migrate(os.path.join(folder_path, "history.yaml"))
+        self.load_index()
+
+    def migrate(self, yaml_path: str):
+        # One time conversion of the history.yaml files written by earlier versions
+        if not os.path.exists(yaml_path):
+            return
+        if os.path.exists(self.file_path) and os.path.getsize(self.file_path) > 0:
+            return
+        try:
+            with open(yaml_path, "r") as f:
+                yaml_history = yaml.safe_load(f)
+            interactions = yaml_history["interactions"] or []
+        except:
+            interactions = []
+        temp_path = f"{self.file_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for interaction in interactions:
+                f.write(
+                    json.dumps(
+                        {
+                            "id": uuid4().hex,
+                            "role": interaction["role"],
+                            "message": interaction["message"],
+                            "timestamp": interaction["timestamp"],
+                        }
+                    )
+                    + "\n"
+                )
+        os.replace(temp_path, self.file_path)
+        os.replace(yaml_path, f"{yaml_path}.bak")
+        logging.info(f"Migrated {len(interactions)} interactions from {yaml_path}.")
+
+    def load_index(self):
+        self.offsets = []
+        self.ids = {}
+        self.tombstones = 0
+        if not os.path.exists(self.file_path):
+            open(self.file_path, "a").close()
+            self.stamp = self.get_stamp()
+            return
+        missing_ids = False
+        offset = 0
+        with open(self.file_path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    interaction = json.loads(line)
+                    if "id" not in interaction:
+                        missing_ids = True
+                    elif interaction.get("deleted"):
+                        self.ids.pop(interaction["id"], None)
+                        self.tombstones += 1
+                    else:
+                        self.ids[interaction["id"]] = offset
+                offset += len(line)
+        if missing_ids:
+            # Give interactions logged before message IDs existed one of their own
+            interactions = []
+            with open(self.file_path, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        interaction.setdefault("id", uuid4().hex)
+                        interactions.append(interaction)
+            self.rewrite(interactions)
+            return
+        self.offsets = sorted(self.ids.values())
+        self.stamp = self.get_stamp()
+
+    def get_stamp(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def refresh(self):
+        # The file was changed behind our back (truncated, replaced or removed),
+        # the offsets no longer point at lines so rebuild them
+        if self.get_stamp() != self.stamp:
+            self.load_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, role: str, message: str):
+        interaction = {
+            "id": uuid4().hex,
+            "role": role,
+            "message": message,
+            "timestamp": datetime.now().strftime("%B %d, %Y %I:%M %p"),
+        }
+        line = (json.dumps(interaction) + "\n").encode("utf-8")
+        with self.lock:
+            self.refresh()
+            with open(self.file_path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(line)
+            self.offsets.append(offset)
+            self.ids[interaction["id"]] = offset
+            self.stamp = self.get_stamp()
+        return interaction
+
+    def read(self, offsets):
+        interactions = []
+        with open(self.file_path, "rb") as f:
+            for position in offsets:
+                f.seek(position)
+                line = f.readline()
+                if line.strip():
+                    interactions.append(json.loads(line))
+        return interactions
+
+    def get(self, offset: int = 0, limit: int = None):
+        with self.lock:
+            self.refresh()
+            offsets = self.offsets[offset:]
+            if limit is not None:
+                offsets = offsets[:limit]
+            return self.read(offsets)
+
+    def rewrite(self, interactions):
+        temp_path = f"{self.file_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for interaction in interactions:
+                f.write(json.dumps(interaction) + "\n")
+        os.replace(temp_path, self.file_path)
+        self.load_index()
+
+    def _delete(self, message_id: str):
+        offset = self.ids.pop(message_id, None)
+        if offset is None:
+            return False
+        del self.offsets[bisect_left(self.offsets, offset)]
+        with open(self.file_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": message_id, "deleted": True}) + "\n")
+        self.tombstones += 1
+        self.stamp = self.get_stamp()
+        return True
+
+    def _compact(self):
+        if self.tombstones > max(HISTORY_COMPACT_THRESHOLD, len(self.offsets)):
+            self.rewrite(self.read(self.offsets))
+
+    def delete(self, message_id: str):
+        with self.lock:
+            self.refresh()
+            deleted = self._delete(message_id)
+            self._compact()
+        return deleted
+
+    def delete_message(self, message: str):
+        with self.lock:
+            self.refresh()
+            for interaction in self.read(self.offsets):
+                if interaction["message"] == message:
+                    self._delete(interaction["id"])
+            self._compact()
+
+    def clear(self):
+        with self.lock:
+            self.rewrite([])
+
+
+_histories = {}
+_histories_lock = threading.Lock()
+
+
+def get_history(folder_path: str):
+    # One History per agent folder so every Agent object shares the same index
+    with _histories_lock:
+        if folder_path not in _histories:
+            _histories[folder_path] = History(folder_path)
+        return _histories[folder_path]
+
+
+def close_history(folder_path: str):
+    with _histories_lock:
+        _histories.pop(folder_path, None)
@@ -0,0 +1,35 @@
+import os
+import asyncio
+import weakref
+import aiohttp
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 600))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_CONNECTION_LIMIT = int(os.getenv("HTTP_CONNECTION_LIMIT", 100))
+HTTP_CONNECTION_LIMIT_PER_HOST = int(os.getenv("HTTP_CONNECTION_LIMIT_PER_HOST", 10))
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_session():
+    # aiohttp sessions are bound to the event loop that created them
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_CONNECTION_LIMIT,
+                limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+                keepalive_timeout=30,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT
+            ),
+        )
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
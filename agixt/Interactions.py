@@ -2,35 +2,46 @@ import re
 import os
 import regex
 import json
-import time
-import spacy
+import asyncio
 from datetime import datetime
-from Agent import Agent
+from Agent import load_agent
 from Prompts import Prompts
 from extensions.searxng import searxng
 from urllib.parse import urlparse
+from Browser import normalize_url
+from provider import CircuitOpenError, is_retryable, is_context_length_error
 import logging
 from concurrent.futures import Future
 
+WEBSEARCH_PAGE_BUDGET = int(os.getenv("WEBSEARCH_PAGE_BUDGET", 20))
+WEBSEARCH_DOMAIN_CONCURRENCY = int(os.getenv("WEBSEARCH_DOMAIN_CONCURRENCY", 2))
+WEBSEARCH_TIMEOUT = float(os.getenv("WEBSEARCH_TIMEOUT", 120))
+
+
+def get_urls(links):
+    if isinstance(links, str):
+        links = [
+            word for word in links.split() if urlparse(word).scheme in ["http", "https"]
+        ]
+    urls = []
+    for link in links:
+        if isinstance(link, dict) and "href" in link:
+            link = link["href"]
+        # Search results are formatted as "title - url"
+        url = re.sub(r"^.*?(http)", r"http", str(link))
+        if url.startswith("http"):
+            urls.append(url)
+    return urls
+
 
 class Interactions:
     def __init__(self, agent_name: str = "AGiXT"):
         self.agent_name = agent_name
-        self.agent = Agent(self.agent_name)
+        self.agent = load_agent(self.agent_name)
         self.agent_commands = self.agent.get_commands_string()
         self.stop_running_event = None
-        self.browsed_links = []
+        self.browsed_links = set()
         self.failures = 0
-        self.nlp = None
-
-    def load_spacy_model(self):
-        if not self.nlp:
-            try:
-                self.nlp = spacy.load("en_core_web_sm")
-            except:
-                spacy.cli.download("en_core_web_sm")
-                self.nlp = spacy.load("en_core_web_sm")
-        self.nlp.max_length = 99999999999999999999999
 
     def custom_format(self, string, **kwargs):
         if isinstance(string, list):
@@ -137,9 +148,7 @@ class Interactions:
             **kwargs,
         )
 
-        if not self.nlp:
-            self.load_spacy_model()
-        tokens = len(self.nlp(formatted_prompt))
+        tokens = self.agent.PROVIDER.count_tokens(formatted_prompt)
         logging.info(f"FORMATTED PROMPT: {formatted_prompt}")
         return formatted_prompt, prompt, tokens
 
@@ -156,50 +165,119 @@ class Interactions:
         **kwargs,
     ):
         logging.info(f"KWARGS: {kwargs}")
-        memories = self.agent.get_memories()
-        if learn_file != "":
-            learning_file = await memories.mem_read_file(file_path=learn_file)
-            if learning_file == False:
-                return "Failed to read file."
-        formatted_prompt, unformatted_prompt, tokens = await self.format_prompt(
-            user_input=user_input,
-            top_results=context_results,
-            prompt=prompt,
-            chain_name=chain_name,
-            step_number=step_number,
-            memories=memories,
-            **kwargs,
-        )
-        if websearch:
-            await self.websearch_agent(user_input=user_input, depth=websearch_depth)
-        try:
-            # Workaround for non-threaded providers
-            run_response = await self.agent.instruct(formatted_prompt, tokens=tokens)
-            self.response = (
-                run_response.result()
-                if isinstance(run_response, Future)
-                else run_response
+        with self.agent.get_memories() as memories:
+            if learn_file != "":
+                learning_file = await memories.mem_read_file(file_path=learn_file)
+                if learning_file == False:
+                    return "Failed to read file."
+            while True:
+                formatted_prompt, unformatted_prompt, tokens = await self.format_prompt(
+                    user_input=user_input,
+                    top_results=context_results,
+                    prompt=prompt,
+                    chain_name=chain_name,
+                    step_number=step_number,
+                    memories=memories,
+                    **kwargs,
+                )
+                if websearch:
+                    # Only search once, retries reuse what it learned
+                    await self.websearch_agent(
+                        user_input=user_input, depth=websearch_depth
+                    )
+                    websearch = False
+                try:
+                    # Workaround for non-threaded providers
+                    run_response = await self.agent.instruct(
+                        formatted_prompt, tokens=tokens
+                    )
+                    self.response = (
+                        run_response.result()
+                        if isinstance(run_response, Future)
+                        else run_response
+                    )
+                    self.failures = 0
+                    break
+                except CircuitOpenError as e:
+                    logging.info(f"Error: {e}")
+                    return None
+                except Exception as e:
+                    logging.info(f"Error: {e}")
+                    logging.info(f"PROMPT CONTENT: {formatted_prompt}")
+                    logging.info(f"TOKENS: {tokens}")
+                    if not is_retryable(e) and not is_context_length_error(e):
+                        # Bad requests and auth failures won't go better next time
+                        self.failures = 0
+                        return None
+                    self.failures += 1
+                    if self.failures == 5:
+                        self.failures = 0
+                        logging.info("Failed to get a response 5 times in a row.")
+                        return None
+                    # The provider already retried transient errors, so back off and
+                    # try again with less context in case the prompt was too long
+                    delay = self.agent.PROVIDER.retry_policy.get_delay(self.failures)
+                    logging.info(f"Retrying in {delay:.1f} seconds...")
+                    await asyncio.sleep(delay)
+                    if context_results > 0:
+                        context_results = context_results - 1
+
+            return await self.handle_response(
+                user_input=user_input,
+                unformatted_prompt=unformatted_prompt,
+                context_results=context_results,
+                memories=memories,
+                **kwargs,
             )
-        except Exception as e:
-            logging.info(f"Error: {e}")
-            logging.info(f"PROMPT CONTENT: {formatted_prompt}")
-            logging.info(f"TOKENS: {tokens}")
-            self.failures += 1
-            if self.failures == 5:
-                self.failures == 0
-                logging.info("Failed to get a response 5 times in a row.")
-                return None
-            logging.info(f"Retrying in 10 seconds...")
-            time.sleep(10)
-            if context_results > 0:
-                context_results = context_results - 1
-            self.response = await self.run(
+
+    async def run_stream(
+        self,
+        user_input: str = "",
+        prompt: str = "",
+        context_results: int = 5,
+        websearch: bool = False,
+        websearch_depth: int = 3,
+        learn_file: str = "",
+        chain_name: str = "",
+        step_number: int = 0,
+        **kwargs,
+    ):
+        # Yields response chunks as they arrive, self.response holds the final response
+        with self.agent.get_memories() as memories:
+            if learn_file != "":
+                learning_file = await memories.mem_read_file(file_path=learn_file)
+                if learning_file == False:
+                    self.response = "Failed to read file."
+                    yield self.response
+                    return
+            formatted_prompt, unformatted_prompt, tokens = await self.format_prompt(
                 user_input=user_input,
+                top_results=context_results,
                 prompt=prompt,
+                chain_name=chain_name,
+                step_number=step_number,
+                memories=memories,
+                **kwargs,
+            )
+            if websearch:
+                await self.websearch_agent(user_input=user_input, depth=websearch_depth)
+            self.response = ""
+            async for chunk in self.agent.instruct_stream(
+                formatted_prompt, tokens=tokens
+            ):
+                self.response += chunk
+                yield chunk
+            await self.handle_response(
+                user_input=user_input,
+                unformatted_prompt=unformatted_prompt,
                 context_results=context_results,
+                memories=memories,
                 **kwargs,
             )
 
+    async def handle_response(
+        self, user_input, unformatted_prompt, context_results, memories, **kwargs
+    ):
         # Handle commands if the prompt contains the {COMMANDS} placeholder
         # We handle command injection that DOESN'T allow command execution by using {command_list} in the prompt
         if "{COMMANDS}" in unformatted_prompt:
@@ -262,9 +340,11 @@ class Interactions:
             )
         )
         if shots > 1:
-            for i in range(shots - 1):
-                answers.append(
-                    await self.run(
+            # The remaining shots reuse what the first one learned and run side by
+            # side, each with its own state, limited by the provider's concurrency
+            answers += await asyncio.gather(
+                *[
+                    Interactions(agent_name=self.agent_name).run(
                         user_input=user_input,
                         prompt="SmartInstruct-StepByStep"
                         if objective == None
@@ -274,7 +354,9 @@ class Interactions:
                         objective=objective,
                         **kwargs,
                     )
-                )
+                    for i in range(shots - 1)
+                ]
+            )
         answer_str = ""
         for i, answer in enumerate(answers):
             answer_str += f"Answer {i + 1}:\n{answer}\n\n"
@@ -320,16 +402,18 @@ class Interactions:
         )
         # Do multi shots of prompt to get N different answers to be validated
         if shots > 1:
-            for i in range(shots - 1):
-                answers.append(
-                    await self.run(
+            answers += await asyncio.gather(
+                *[
+                    Interactions(agent_name=self.agent_name).run(
                         user_input=user_input,
                         prompt="SmartChat-StepByStep",
                         context_results=6,
                         shots=shots,
                         **kwargs,
                     )
-                )
+                    for i in range(shots - 1)
+                ]
+            )
         answer_str = ""
         for i, answer in enumerate(answers):
             answer_str += f"Answer {i + 1}:\n{answer}\n\n"
@@ -435,69 +519,81 @@ class Interactions:
         user_input: str = "What are the latest breakthroughs in AI?",
         depth: int = 3,
     ):
-        memories = self.agent.get_memories()
+        # Crawls search results and the links the agent picks from them in
+        # parallel, within a page budget, per domain limits and a deadline
+        domains = {}
+        tasks = set()
+        pages = 0
+
+        def visit(links):
+            nonlocal pages
+            for url in get_urls(links):
+                normalized_url = normalize_url(url)
+                if normalized_url in self.browsed_links:
+                    continue
+                if pages >= WEBSEARCH_PAGE_BUDGET:
+                    return
+                self.browsed_links.add(normalized_url)
+                pages += 1
+                tasks.add(asyncio.create_task(browse(url)))
 
-        async def resursive_browsing(user_input, links):
+        async def browse(url):
+            domain = urlparse(url).netloc
+            if domain not in domains:
+                domains[domain] = asyncio.Semaphore(WEBSEARCH_DOMAIN_CONCURRENCY)
+            async with domains[domain]:
+                logging.info(f"Scraping: {url}")
+                with self.agent.get_memories() as memories:
+                    collected_data, link_list = await memories.read_website(url)
+            if not link_list:
+                return
+            if len(link_list) > 5:
+                link_list = link_list[:3]
             try:
-                words = links.split()
-                links = [
-                    word for word in words if urlparse(word).scheme in ["http", "https"]
-                ]
+                pick_a_link = await Interactions(agent_name=self.agent_name).run(
+                    user_input=user_input,
+                    prompt="Pick-a-Link",
+                    links=link_list,
+                )
+                if not pick_a_link.startswith("None"):
+                    visit(pick_a_link)
             except:
-                links = links
-            if links is not None:
-                for link in links:
-                    if "href" in link:
-                        try:
-                            url = link["href"]
-                        except:
-                            url = link
-                    else:
-                        url = link
-                    url = re.sub(r"^.*?(http)", r"http", url)
-                    # Check if url is an actual url
-                    if url.startswith("http"):
-                        logging.info(f"Scraping: {url}")
-                        if url not in self.browsed_links:
-                            self.browsed_links.append(url)
-                            (
-                                collected_data,
-                                link_list,
-                            ) = await memories.read_website(url)
-                            if link_list is not None:
-                                if len(link_list) > 0:
-                                    if len(link_list) > 5:
-                                        link_list = link_list[:3]
-                                    try:
-                                        pick_a_link = await self.run(
-                                            user_input=user_input,
-                                            prompt="Pick-a-Link",
-                                            links=link_list,
-                                        )
-                                        if not pick_a_link.startswith("None"):
-                                            await resursive_browsing(
-                                                user_input, pick_a_link
-                                            )
-                                    except:
-                                        logging.info(
-                                            f"Issues reading {url}. Moving on..."
-                                        )
+                logging.info(f"Issues reading {url}. Moving on...")
 
-        results = await self.run(user_input=user_input, prompt="WebSearch")
-        results = results.split("\n")
-        for result in results:
-            search_string = result.lstrip("0123456789. ")
+        async def search():
+            results = await self.run(user_input=user_input, prompt="WebSearch")
+            search_strings = [
+                result.lstrip("0123456789. ") for result in results.split("\n")
+            ]
             try:
                 searx_server = self.agent.PROVIDER_SETTINGS["SEARXNG_INSTANCE_URL"]
             except:
                 searx_server = ""
-            try:
-                links = await searxng(SEARXNG_INSTANCE_URL=searx_server).search(
-                    search_string
-                )
-                if len(links) > depth:
-                    links = links[:depth]
-            except:
-                links = None
-            if links is not None:
-                await resursive_browsing(user_input, links)
+            search_engine = searxng(SEARXNG_INSTANCE_URL=searx_server)
+            searches = await asyncio.gather(
+                *[
+                    search_engine.search(search_string)
+                    for search_string in search_strings
+                    if search_string
+                ],
+                return_exceptions=True,
+            )
+            for links in searches:
+                if isinstance(links, list):
+                    visit(links[:depth])
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                tasks.difference_update(done)
+
+        # The deadline covers picking search terms and searching, not only pages
+        try:
+            await asyncio.wait_for(search(), timeout=WEBSEARCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.info(f"Web search timed out, skipping {len(tasks)} pages.")
+        finally:
+            # Stop cancelled pages from queueing new ones, then wait for them to
+            # unwind so their sessions and memories are released
+            pages = WEBSEARCH_PAGE_BUDGET
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -3,55 +3,231 @@ import spacy
 import os
 from hashlib import sha256
 from Embedding import Embedding
+from Tokens import count_tokens
 from datetime import datetime
 from collections import Counter
 import pandas as pd
 import docx2txt
 import pdfplumber
-from playwright.async_api import async_playwright
+from Browser import get_page_cache, read_page
 from semantic_kernel.connectors.memory.chroma import ChromaMemoryStore
-from semantic_kernel.memory.memory_record import MemoryRecord
 from chromadb.config import Settings
-from bs4 import BeautifulSoup
 import logging
 import asyncio
+import time
+import threading
 import sys
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
 
+_nlp = None
+_nlp_lock = threading.Lock()
+
+
+def load_spacy_model():
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            try:
+                nlp = spacy.load("en_core_web_sm")
+            except:
+                spacy.cli.download("en_core_web_sm")
+                nlp = spacy.load("en_core_web_sm")
+            nlp.max_length = 99999999999999999999999
+            _nlp = nlp
+    return _nlp
+
+
+class PersistPolicy:
+    def __init__(self, every: int = 100, interval: float = 60):
+        self.every = every
+        self.interval = interval
+        self.pending = 0
+        self.last_persist = time.time()
+        self.client = None
+        self.lock = threading.Lock()
+
+    def record(self, client, count: int):
+        with self.lock:
+            self.client = client
+            self.pending += count
+            if (
+                self.pending >= self.every
+                or time.time() - self.last_persist >= self.interval
+            ):
+                self._persist()
+
+    def flush(self):
+        with self.lock:
+            if self.pending > 0:
+                self._persist()
+
+    def _persist(self):
+        try:
+            self.client.persist()
+        except Exception as e:
+            logging.info(f"Failed to persist memories: {e}")
+        self.pending = 0
+        self.last_persist = time.time()
+
+
+_persist_policies = {}
+_persist_policies_lock = threading.Lock()
+
+
+def get_persist_policy(memories_dir: str, agent_config=None):
+    try:
+        settings = agent_config["settings"]
+    except:
+        settings = {}
+    every = int(
+        settings.get("MEMORY_PERSIST_EVERY", os.getenv("MEMORY_PERSIST_EVERY", 100))
+    )
+    interval = float(
+        settings.get(
+            "MEMORY_PERSIST_INTERVAL", os.getenv("MEMORY_PERSIST_INTERVAL", 60)
+        )
+    )
+    with _persist_policies_lock:
+        if memories_dir not in _persist_policies:
+            _persist_policies[memories_dir] = PersistPolicy()
+        policy = _persist_policies[memories_dir]
+        policy.every = every
+        policy.interval = interval
+        return policy
+
+
+def persist_memories():
+    with _persist_policies_lock:
+        policies = list(_persist_policies.values())
+    for policy in policies:
+        policy.flush()
+
+
+MEMORY_STORE_IDLE_TIMEOUT = float(os.getenv("MEMORY_STORE_IDLE_TIMEOUT", 600))
+_memory_stores = {}
+_memory_stores_lock = threading.Lock()
+
+
+def get_memories_dir(agent_name: str):
+    return os.path.join(os.getcwd(), "agents", agent_name, "memories")
+
+
+def _close_memory_store(agent_name: str, force: bool = False):
+    # Caller must hold _memory_stores_lock. Stores still held by a Memories are
+    # left open unless forced, returns whether the store was closed.
+    entry = _memory_stores.get(agent_name)
+    if entry is not None and entry["refs"] > 0 and not force:
+        return False
+    _memory_stores.pop(agent_name, None)
+    with _persist_policies_lock:
+        policy = _persist_policies.pop(get_memories_dir(agent_name), None)
+    if entry is not None:
+        # Chroma keeps collections in an in-memory DuckDB, persisting writes them
+        # to the memories folder before the client is dropped
+        try:
+            entry["store"]._client.persist()
+        except Exception as e:
+            logging.info(f"Failed to persist memories for {agent_name}: {e}")
+    elif policy is not None:
+        policy.flush()
+    return True
+
+
+def _evict_idle_memory_stores():
+    # Caller must hold _memory_stores_lock
+    now = time.time()
+    for agent_name, entry in list(_memory_stores.items()):
+        if entry["refs"] <= 0 and now - entry["last_used"] >= MEMORY_STORE_IDLE_TIMEOUT:
+            logging.info(f"Closing idle memory store for {agent_name}")
+            _close_memory_store(agent_name)
+
+
+def acquire_memory_store(agent_name: str):
+    with _memory_stores_lock:
+        _evict_idle_memory_stores()
+        if agent_name not in _memory_stores:
+            memories_dir = get_memories_dir(agent_name)
+            _memory_stores[agent_name] = {
+                "store": ChromaMemoryStore(
+                    persist_directory=memories_dir,
+                    client_settings=Settings(
+                        chroma_db_impl="chromadb.db.duckdb.PersistentDuckDB",
+                        persist_directory=memories_dir,
+                        anonymized_telemetry=False,
+                    ),
+                ),
+                "refs": 0,
+                "last_used": time.time(),
+            }
+        entry = _memory_stores[agent_name]
+        entry["refs"] += 1
+        entry["last_used"] = time.time()
+        return entry["store"]
+
+
+def release_memory_store(agent_name: str):
+    with _memory_stores_lock:
+        if agent_name in _memory_stores:
+            entry = _memory_stores[agent_name]
+            entry["refs"] = max(entry["refs"] - 1, 0)
+            entry["last_used"] = time.time()
+
+
+def close_memory_store(agent_name: str):
+    with _memory_stores_lock:
+        return _close_memory_store(agent_name)
+
+
+def close_memory_stores():
+    with _memory_stores_lock:
+        for agent_name in list(_memory_stores):
+            _close_memory_store(agent_name, force=True)
+    persist_memories()
+
+
 class Memories:
-    def __init__(self, agent_name: str = "AGiXT", agent_config=None):
+    def __init__(
+        self, agent_name: str = "AGiXT", agent_config=None, count_tokens=count_tokens
+    ):
         self.agent_name = agent_name
         self.agent_config = agent_config
+        self.count_tokens = count_tokens
         self.chroma_client = None
         self.collection = None
         self.nlp = None
         self.chunk_size = 128
-        memories_dir = os.path.join(os.getcwd(), "agents", self.agent_name, "memories")
-        self.chroma_client = ChromaMemoryStore(
-            persist_directory=memories_dir,
-            client_settings=Settings(
-                chroma_db_impl="chromadb.db.duckdb.PersistentDuckDB",
-                persist_directory=memories_dir,
-                anonymized_telemetry=False,
-            ),
+        self.embedding = Embedding(AGENT_CONFIG=agent_config, agent_name=agent_name)
+        self.chroma_client = acquire_memory_store(self.agent_name)
+        self.persist_policy = get_persist_policy(
+            get_memories_dir(self.agent_name), agent_config
         )
 
+    def close(self):
+        if self.chroma_client is not None:
+            self.chroma_client = None
+            release_memory_store(self.agent_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except:
+            pass
+
     def load_spacy_model(self):
         if not self.nlp:
-            try:
-                self.nlp = spacy.load("en_core_web_sm")
-            except:
-                spacy.cli.download("en_core_web_sm")
-                self.nlp = spacy.load("en_core_web_sm")
-        self.nlp.max_length = 99999999999999999999999
+            self.nlp = load_spacy_model()
 
     async def get_embedder(self):
-        embedder, chunk_size = await Embedding(
-            AGENT_CONFIG=self.agent_config
-        ).get_embedder()
+        embedder, chunk_size = await self.embedding.get_embedder()
         return embedder, chunk_size
 
     async def get_collection(self):
@@ -75,26 +251,65 @@ class Memories:
             raise RuntimeError(f"Unable to initialize chroma client: {e}")
 
     async def store_memory(
-        self, content: str, description: str = None, external_source_name: str = None
+        self,
+        content: str,
+        description: str = None,
+        external_source_name: str = None,
+        embedding=None,
     ):
-        embedder, chunk_size = await self.get_embedder()
-        collection = await self.get_collection()
-        record = MemoryRecord(
-            is_reference=False,
-            id=sha256((content + datetime.now().isoformat()).encode()).hexdigest(),
-            text=content,
-            timestamp=datetime.now().isoformat(),
-            description=description,
-            external_source_name=external_source_name,  # URL or File path
-            embedding=await embedder(content),
+        await self.store_memories(
+            [
+                {
+                    "content": content,
+                    "description": description,
+                    "external_source_name": external_source_name,
+                    "embedding": embedding,
+                }
+            ]
         )
 
+    async def store_memories(self, records: List[dict]):
+        if not records:
+            return
+        missing = [record for record in records if record.get("embedding") is None]
+        if missing:
+            embeddings = await self.embedding.embed_batch(
+                [record["content"] for record in missing]
+            )
+            for record, embedding in zip(missing, embeddings):
+                record["embedding"] = embedding
+        collection = await self.get_collection()
+        timestamp = datetime.now().isoformat()
         try:
-            await self.chroma_client.upsert_async(
-                collection_name="memories",
-                record=record,
+            # One add for the whole batch, the semantic kernel store adds them one
+            # at a time. Metadata matches what its upsert_async writes.
+            collection.add(
+                ids=[
+                    sha256(
+                        (record["content"] + timestamp + str(i)).encode()
+                    ).hexdigest()
+                    for i, record in enumerate(records)
+                ],
+                embeddings=[
+                    record["embedding"].tolist()
+                    if hasattr(record["embedding"], "tolist")
+                    else list(record["embedding"])
+                    for record in records
+                ],
+                documents=[record["content"] for record in records],
+                metadatas=[
+                    {
+                        "timestamp": timestamp,
+                        "is_reference": False,
+                        # URL or File path
+                        "external_source_name": record.get("external_source_name")
+                        or "",
+                        "description": record.get("description") or "",
+                    }
+                    for record in records
+                ],
             )
-            self.chroma_client._client.persist()
+            self.persist_policy.record(self.chroma_client._client, len(records))
         except Exception as e:
             logging.info(f"Failed to store memory: {e}")
 
@@ -105,21 +320,24 @@ class Memories:
             if not isinstance(result, str):
                 result = str(result)
             chunks = await self.chunk_content(result, input)
-            for chunk in chunks:
-                await self.store_memory(
-                    content=chunk,
-                    description=input,
-                    external_source_name=external_source_name,
-                )
+            await self.store_memories(
+                [
+                    {
+                        "content": chunk,
+                        "description": input,
+                        "external_source_name": external_source_name,
+                    }
+                    for chunk in chunks
+                ]
+            )
 
     async def context_agent(self, query: str, top_results_num: int) -> List[str]:
-        embedder, chunk_size = await self.get_embedder()
         collection = await self.get_collection()
         if collection == None:
             return []
         results = await self.chroma_client.get_nearest_matches_async(
             collection_name="memories",
-            embedding=await embedder(query),
+            embedding=await self.embedding.embed_text(query),
             limit=top_results_num,
             min_relevance_score=0.1,
         )
@@ -134,12 +352,10 @@ class Memories:
 
     async def trim_context(self, context: List[str]) -> List[str]:
         embedder, chunk_size = await self.get_embedder()
-        if not self.nlp:
-            self.load_spacy_model()
         trimmed_context = []
         total_tokens = 0
         for item in context:
-            item_tokens = len(self.nlp(item))
+            item_tokens = self.count_tokens(item)
             if total_tokens + item_tokens <= chunk_size:
                 trimmed_context.append(item)
                 total_tokens += item_tokens
@@ -151,7 +367,7 @@ class Memories:
         """Extract keywords from a query using Spacy's part-of-speech tagging."""
         if not self.nlp:
             self.load_spacy_model()
-        doc = self.nlp(query)
+        doc = self.nlp(query, disable=["parser", "ner", "lemmatizer"])
         keywords = [
             token.text for token in doc if token.pos_ in {"NOUN", "PROPN", "VERB"}
         ]
@@ -169,22 +385,30 @@ class Memories:
         embedder, chunk_size = await self.get_embedder()
         if not self.nlp:
             self.load_spacy_model()
-        doc = self.nlp(content)
+        # Sentence boundaries come from the parser, the other components are unused
+        doc = self.nlp(
+            content, disable=["tagger", "attribute_ruler", "lemmatizer", "ner"]
+        )
         sentences = list(doc.sents)
+        sentence_lengths = [self.count_tokens(sentence.text) for sentence in sentences]
         content_chunks = []
         chunk = []
         chunk_len = 0
         keywords = self.get_keywords(query)
 
         for i, sentence in enumerate(sentences):
-            sentence_tokens = len(sentence)
+            sentence_tokens = sentence_lengths[i]
             if chunk_len + sentence_tokens > chunk_size and chunk:
                 chunk_text = " ".join(token.text for token in chunk)
                 content_chunks.append(
                     (self.score_chunk(chunk_text, keywords), chunk_text)
                 )
-                chunk = list(sentences[i - overlap : i]) if i - overlap >= 0 else []
-                chunk_len = sum(len(s) for s in chunk)
+                if i - overlap >= 0:
+                    chunk = list(sentences[i - overlap : i])
+                    chunk_len = sum(sentence_lengths[i - overlap : i])
+                else:
+                    chunk = []
+                    chunk_len = 0
             chunk.extend(sentence)
             chunk_len += sentence_tokens
 
@@ -224,27 +448,12 @@ class Memories:
 
     async def read_website(self, url):
         try:
-            async with async_playwright() as p:
-                browser = await p.chromium.launch()
-                context = await browser.new_context()
-                page = await context.new_page()
-                await page.goto(url)
-                content = await page.content()
-
-                # Scrape links and their titles
-                links = await page.query_selector_all("a")
-                link_list = []
-                for link in links:
-                    title = await page.evaluate("(link) => link.textContent", link)
-                    href = await page.evaluate("(link) => link.href", link)
-                    link_list.append((title, href))
-
-                await browser.close()
-                soup = BeautifulSoup(content, "html.parser")
-                text_content = soup.get_text()
-                text_content = " ".join(text_content.split())
-                if text_content:
-                    await self.store_result(input=url, result=text_content)
-                return text_content, link_list
+            page = await read_page(url)
+            page_cache = get_page_cache()
+            # Pages this agent already learned are not stored again until they change
+            if page["text"] and not page_cache.is_ingested(page, self.agent_name):
+                await self.store_result(input=url, result=page["text"])
+                page_cache.mark_ingested(page, self.agent_name)
+            return page["text"], page["links"]
         except:
             return None, None
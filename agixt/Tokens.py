@@ -0,0 +1,55 @@
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 10000))
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+_tiktoken_encodings = {}
+
+
+def estimate_tokens(text: str):
+    # BPE tokenizers average roughly 4 characters per token for English text
+    words = len(re.findall(r"\w+|[^\w\s]", text))
+    return max(words, round(len(text) / 4))
+
+
+def get_tiktoken_counter(model: str):
+    if model not in _tiktoken_encodings:
+        try:
+            import tiktoken
+        except ImportError:
+            logging.info("tiktoken is not installed, estimating token counts.")
+            return None
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        _tiktoken_encodings[model] = encoding
+    encoding = _tiktoken_encodings[model]
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: str, counter=None, counter_name: str = "estimate"):
+    if not text:
+        return 0
+    if counter is None:
+        counter_name = "estimate"
+    key = (counter_name, sha256(text.encode()).hexdigest())
+    with _token_counts_lock:
+        if key in _token_counts:
+            _token_counts.move_to_end(key)
+            return _token_counts[key]
+    try:
+        tokens = counter(text) if counter is not None else estimate_tokens(text)
+    except Exception as e:
+        logging.info(f"Unable to count tokens with {counter_name}: {e}")
+        tokens = estimate_tokens(text)
+    with _token_counts_lock:
+        _token_counts[key] = tokens
+        while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return tokens
@@ -1,16 +1,36 @@
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from Interactions import Interactions
-from Agent import Agent, add_agent, delete_agent, rename_agent, get_agents
+from Agent import (
+    load_agent,
+    add_agent,
+    delete_agent,
+    rename_agent,
+    get_agents,
+    get_agent_file_paths,
+    invalidate_agents,
+)
 from Chain import Chain
 from Prompts import Prompts
 from typing import Optional, Dict, List, Any
 from provider import get_provider_options, get_providers
-from Embedding import get_embedding_providers
-from Extensions import Extensions
+from Embedding import get_embedding_providers, warm_embedders
+from Extensions import (
+    Extensions,
+    EXTENSION_IMPORT_REPORT,
+    load_extensions,
+    reload_extensions,
+    report_import_costs,
+    shutdown_extensions,
+)
+from Memories import close_memory_stores
+from HttpClient import close_session
+from Browser import close_browser_pool
 import os
+import json
 import logging
 
 this_directory = os.path.abspath(os.path.dirname(__file__))
@@ -38,6 +58,32 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup_event():
+    agent_configs = []
+    for agent in get_agents():
+        try:
+            config_path, _, _ = get_agent_file_paths(agent_name=agent["name"])
+            with open(config_path, "r") as f:
+                agent_configs.append(json.load(f))
+        except:
+            pass
+    warmed = await warm_embedders(agent_configs=agent_configs)
+    logging.info(f"Warmed up embedders: {warmed}")
+    extensions = load_extensions()
+    logging.info(f"Loaded extensions: {list(extensions)}")
+    if EXTENSION_IMPORT_REPORT:
+        report_import_costs()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await shutdown_extensions()
+    close_memory_stores()
+    await close_browser_pool()
+    await close_session()
+
+
 class AgentName(BaseModel):
     agent_name: str
 
@@ -143,6 +189,20 @@ class AgentCommands(BaseModel):
     commands: Dict[str, Any]
 
 
+def stream_run(agent: Interactions, **kwargs):
+    # Server-sent events: one event per chunk, then the final processed response
+    async def event_stream():
+        try:
+            async for chunk in agent.run_stream(**kwargs):
+                yield f"data: {json.dumps({'token': chunk})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'response': str(agent.response)})}\n\n"
+        except Exception as e:
+            logging.info(f"Streaming error: {e}")
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.get("/api/provider", tags=["Provider"])
 async def getproviders():
     providers = get_providers()
@@ -168,7 +228,10 @@ async def addagent(agent: AgentSettings) -> Dict[str, str]:
 
 @app.patch("/api/agent/{agent_name}", tags=["Agent"])
 async def renameagent(agent_name: str, new_name: AgentNewName) -> ResponseMessage:
-    rename_agent(agent_name=agent_name, new_name=new_name.new_name)
+    await shutdown_extensions(agent_name)
+    result = rename_agent(agent_name=agent_name, new_name=new_name.new_name)
+    if result is not None and result[1] != 200:
+        raise HTTPException(status_code=result[1], detail=result[0]["message"])
     return ResponseMessage(message="Agent renamed.")
 
 
@@ -176,7 +239,7 @@ async def renameagent(agent_name: str, new_name: AgentNewName) -> ResponseMessag
 async def update_agent_settings(
     agent_name: str, settings: AgentSettings
 ) -> ResponseMessage:
-    update_config = Agent(agent_name=agent_name).update_agent_config(
+    update_config = load_agent(agent_name=agent_name).update_agent_config(
         new_config=settings.settings, config_key="settings"
     )
     return ResponseMessage(message=update_config)
@@ -191,8 +254,8 @@ async def learn_file(agent_name: str, file: FileInput) -> ResponseMessage:
     with open(file_path, "w") as f:
         f.write(file.file_content)
     try:
-        memories = Agent(agent_name=agent_name).get_memories()
-        await memories.mem_read_file(file_path=file.file_content)
+        with load_agent(agent_name=agent_name).get_memories() as memories:
+            await memories.mem_read_file(file_path=file.file_content)
         try:
             os.remove(file_path)
         except Exception:
@@ -209,8 +272,8 @@ async def learn_file(agent_name: str, file: FileInput) -> ResponseMessage:
 @app.post("/api/agent/{agent_name}/learn/url", tags=["Agent"])
 async def learn_url(agent_name: str, url: UrlInput) -> ResponseMessage:
     try:
-        memories = Agent(agent_name=agent_name).get_memories()
-        await memories.read_website(url=url.url)
+        with load_agent(agent_name=agent_name).get_memories() as memories:
+            await memories.read_website(url=url.url)
         return ResponseMessage(message="Agent learned the content from the url.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -220,7 +283,7 @@ async def learn_url(agent_name: str, url: UrlInput) -> ResponseMessage:
 async def update_agent_commands(
     agent_name: str, commands: AgentCommands
 ) -> ResponseMessage:
-    update_config = Agent(agent_name=agent_name).update_agent_config(
+    update_config = load_agent(agent_name=agent_name).update_agent_config(
         new_config=commands.commands, config_key="commands"
     )
     return ResponseMessage(message=update_config)
@@ -228,7 +291,10 @@ async def update_agent_commands(
 
 @app.delete("/api/agent/{agent_name}", tags=["Agent"])
 async def deleteagent(agent_name: str) -> ResponseMessage:
-    delete_agent(agent_name=agent_name)
+    await shutdown_extensions(agent_name)
+    result, status_code = delete_agent(agent_name=agent_name)
+    if status_code != 200:
+        raise HTTPException(status_code=status_code, detail=result["message"])
     return ResponseMessage(message=f"Agent {agent_name} deleted.")
 
 
@@ -240,19 +306,33 @@ async def getagents():
 
 @app.get("/api/agent/{agent_name}", tags=["Agent"])
 async def get_agentconfig(agent_name: str):
-    agent_config = Agent(agent_name=agent_name).get_agent_config()
+    agent_config = load_agent(agent_name=agent_name).AGENT_CONFIG
     return {"agent": agent_config}
 
 
 @app.get("/api/{agent_name}/chat", tags=["Agent"])
-async def get_chat_history(agent_name: str):
-    chat_history = Agent(agent_name=agent_name).get_history()
+async def get_chat_history(
+    agent_name: str, offset: int = 0, limit: Optional[int] = None
+):
+    chat_history = load_agent(agent_name=agent_name).get_history(
+        offset=offset, limit=limit
+    )
     return {"chat_history": chat_history}
 
 
+@app.get("/api/agent/{agent_name}/history", tags=["Agent"])
+async def get_history_messages(
+    agent_name: str, offset: int = 0, limit: Optional[int] = None
+):
+    history = load_agent(agent_name=agent_name).get_history_messages(
+        offset=offset, limit=limit
+    )
+    return {"history": history}
+
+
 @app.delete("/api/agent/{agent_name}/history", tags=["Agent"])
 async def delete_history(agent_name: str) -> ResponseMessage:
-    Agent(agent_name=agent_name).delete_history()
+    load_agent(agent_name=agent_name).delete_history()
     return ResponseMessage(message=f"History for agent {agent_name} deleted.")
 
 
@@ -260,13 +340,26 @@ async def delete_history(agent_name: str) -> ResponseMessage:
 async def delete_history_message(
     agent_name: str, message: ResponseMessage
 ) -> ResponseMessage:
-    Agent(agent_name=agent_name).delete_history_message(message.message)
+    load_agent(agent_name=agent_name).delete_history_message(message.message)
     return ResponseMessage(message=f"Message deleted.")
 
 
+@app.delete("/api/agent/{agent_name}/history/{message_id}", tags=["Agent"])
+async def delete_history_message_by_id(
+    agent_name: str, message_id: str
+) -> ResponseMessage:
+    result = load_agent(agent_name=agent_name).delete_history_message_by_id(message_id)
+    if result == "Message not found.":
+        raise HTTPException(status_code=404, detail=result)
+    return ResponseMessage(message=result)
+
+
 @app.delete("/api/agent/{agent_name}/memory", tags=["Agent"])
 async def wipe_agent_memories(agent_name: str) -> ResponseMessage:
-    Agent(agent_name=agent_name).wipe_agent_memories()
+    if not load_agent(agent_name=agent_name).wipe_agent_memories():
+        raise HTTPException(
+            status_code=409, detail=f"Memories for agent {agent_name} are in use."
+        )
     return ResponseMessage(message=f"Memories for agent {agent_name} deleted.")
 
 
@@ -280,6 +373,12 @@ async def instruct(agent_name: str, prompt: Prompt):
     return {"response": str(response)}
 
 
+@app.post("/api/agent/{agent_name}/instruct/stream", tags=["Agent"])
+async def instruct_stream(agent_name: str, prompt: Prompt):
+    agent = Interactions(agent_name=agent_name)
+    return stream_run(agent, user_input=prompt.prompt, prompt="instruct")
+
+
 @app.post("/api/agent/{agent_name}/prompt", tags=["Agent"])
 async def prompt_agent(agent_name: str, agent_prompt: AgentPrompt):
     agent = Interactions(agent_name=agent_name)
@@ -293,6 +392,19 @@ async def prompt_agent(agent_name: str, agent_prompt: AgentPrompt):
     return {"response": str(response)}
 
 
+@app.post("/api/agent/{agent_name}/prompt/stream", tags=["Agent"])
+async def prompt_agent_stream(agent_name: str, agent_prompt: AgentPrompt):
+    agent = Interactions(agent_name=agent_name)
+    return stream_run(
+        agent,
+        prompt=agent_prompt.prompt_name,
+        websearch=agent_prompt.websearch,
+        websearch_depth=agent_prompt.websearch_depth,
+        context_results=agent_prompt.context_results,
+        **agent_prompt.prompt_args,
+    )
+
+
 @app.post("/api/agent/{agent_name}/smartinstruct/{shots}", tags=["Agent"])
 async def smartinstruct(agent_name: str, shots: int, prompt: Prompt):
     agent = Interactions(agent_name=agent_name)
@@ -309,6 +421,12 @@ async def chat(agent_name: str, prompt: Prompt):
     return {"response": str(response)}
 
 
+@app.post("/api/agent/{agent_name}/chat/stream", tags=["Agent"])
+async def chat_stream(agent_name: str, prompt: Prompt):
+    agent = Interactions(agent_name=agent_name)
+    return stream_run(agent, user_input=prompt.prompt, prompt="Chat", context_results=6)
+
+
 @app.post("/api/agent/{agent_name}/smartchat/{shots}", tags=["Agent"])
 async def smartchat(agent_name: str, shots: int, prompt: Prompt):
     agent = Interactions(agent_name=agent_name)
@@ -318,7 +436,7 @@ async def smartchat(agent_name: str, shots: int, prompt: Prompt):
 
 @app.get("/api/agent/{agent_name}/command", tags=["Agent"])
 async def get_commands(agent_name: str):
-    agent = Agent(agent_name=agent_name)
+    agent = load_agent(agent_name=agent_name)
     return {"commands": agent.agent_config["commands"]}
 
 
@@ -326,7 +444,7 @@ async def get_commands(agent_name: str):
 async def toggle_command(
     agent_name: str, payload: ToggleCommandPayload
 ) -> ResponseMessage:
-    agent = Agent(agent_name=agent_name)
+    agent = load_agent(agent_name=agent_name)
     print(payload)
     try:
         if payload.command_name == "*":
@@ -520,5 +638,14 @@ async def get_extensions():
     return {"extensions": Extensions().get_extensions()}
 
 
+@app.post("/api/extensions/reload", tags=["Extension"])
+async def reload_extension_registry() -> ResponseMessage:
+    # Running instances are built from the old code, shut them down first
+    await shutdown_extensions()
+    extensions = reload_extensions()
+    invalidate_agents()
+    return ResponseMessage(message=f"Reloaded {len(extensions)} extensions.")
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=7437)
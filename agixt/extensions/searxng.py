@@ -1,47 +1,129 @@
-import json
+import os
+import time
 import random
-import requests
+import logging
+import aiohttp
+from collections import OrderedDict
 from typing import List
 from Extensions import Extensions
+from HttpClient import get_session
+
+DEFAULT_SEARXNG_INSTANCE_URL = "https://search.us.projectsegfau.lt"
+SEARXNG_INSTANCES_TTL = float(os.getenv("SEARXNG_INSTANCES_TTL", 3600))
+SEARXNG_RESULTS_TTL = float(os.getenv("SEARXNG_RESULTS_TTL", 3600))
+SEARXNG_RESULTS_CACHE_SIZE = int(os.getenv("SEARXNG_RESULTS_CACHE_SIZE", 1000))
+SEARXNG_MAX_ATTEMPTS = int(os.getenv("SEARXNG_MAX_ATTEMPTS", 3))
+SEARXNG_TIMEOUT = float(os.getenv("SEARXNG_TIMEOUT", 10))
+_instances = {"servers": [], "fetched_at": 0}
+_health = {}
+_results = OrderedDict()
+
+
+async def get_instances():
+    # SearXNG - List of these at https://searx.space/
+    if time.time() - _instances["fetched_at"] < SEARXNG_INSTANCES_TTL:
+        return _instances["servers"]
+    try:
+        async with get_session().get(
+            "https://searx.space/data/instances.json",
+            timeout=aiohttp.ClientTimeout(total=SEARXNG_TIMEOUT),
+        ) as response:
+            data = await response.json(content_type=None)
+        _instances["servers"] = [
+            server.rstrip("/") for server in data["instances"].keys()
+        ]
+    except Exception as e:
+        logging.info(f"Unable to get the SearXNG instance list: {e}")
+    # Failed lookups are also cached so searches don't wait on searx.space again
+    _instances["fetched_at"] = time.time()
+    return _instances["servers"]
+
+
+def get_score(server: str):
+    # Lower is better, instances not tried yet get an average latency with a
+    # little jitter so new ones are explored in turn
+    health = _health.get(server)
+    if health is None:
+        return 2 + random.random()
+    return health["latency"]
+
+
+def record_success(server: str, latency: float):
+    health = _health.get(server)
+    if health is None:
+        _health[server] = {"latency": latency, "failures": 0, "retry_at": 0}
+    else:
+        health["latency"] = health["latency"] * 0.7 + latency * 0.3
+        health["failures"] = 0
+        health["retry_at"] = 0
+
+
+def record_failure(server: str):
+    health = _health.setdefault(
+        server, {"latency": SEARXNG_TIMEOUT, "failures": 0, "retry_at": 0}
+    )
+    health["failures"] += 1
+    # Back off from failing instances for up to an hour
+    health["retry_at"] = time.time() + min(60 * 2 ** health["failures"], 3600)
+
+
+def is_available(server: str):
+    health = _health.get(server)
+    return health is None or health["retry_at"] <= time.time()
 
 
 class searxng(Extensions):
     def __init__(self, SEARXNG_INSTANCE_URL: str = "", **kwargs):
-        self.SEARXNG_INSTANCE_URL = SEARXNG_INSTANCE_URL
-        self.SEARXNG_ENDPOINT = self.get_server()
+        self.SEARXNG_INSTANCE_URL = SEARXNG_INSTANCE_URL.rstrip("/")
         self.commands = {"Use The Search Engine": self.search}
 
-    def get_server(self):
-        if self.SEARXNG_INSTANCE_URL == "":
-            try:  # SearXNG - List of these at https://searx.space/
-                response = requests.get("https://searx.space/data/instances.json")
-                data = json.loads(response.text)
-                servers = list(data["instances"].keys())
-                random_index = random.randint(0, len(servers) - 1)
-                self.SEARXNG_INSTANCE_URL = servers[random_index]
-            except:  # Select default remote server that typically works if unable to get list.
-                self.SEARXNG_INSTANCE_URL = "https://search.us.projectsegfau.lt"
-        server = self.SEARXNG_INSTANCE_URL.rstrip("/")
-        endpoint = f"{server}/search"
-        return endpoint
+    async def get_servers(self):
+        if self.SEARXNG_INSTANCE_URL != "":
+            servers = [self.SEARXNG_INSTANCE_URL]
+        else:
+            servers = sorted(
+                [server for server in await get_instances() if is_available(server)],
+                key=get_score,
+            )
+        servers = servers[:SEARXNG_MAX_ATTEMPTS]
+        # Select default remote server that typically works if the others fail.
+        if DEFAULT_SEARXNG_INSTANCE_URL not in servers:
+            servers.append(DEFAULT_SEARXNG_INSTANCE_URL)
+        return servers
 
     async def search(self, query: str) -> List[str]:
-        try:
-            response = requests.get(
-                self.SEARXNG_ENDPOINT,
-                params={
-                    "q": query,
-                    "language": "en",
-                    "safesearch": 1,
-                    "format": "json",
-                },
-            )
-            results = response.json()
-            summaries = [
-                result["title"] + " - " + result["url"] for result in results["results"]
-            ]
+        # Agents with their own instance don't share results with the others
+        key = (self.SEARXNG_INSTANCE_URL, query)
+        cached = _results.get(key)
+        if cached is not None and time.time() - cached[0] < SEARXNG_RESULTS_TTL:
+            _results.move_to_end(key)
+            return cached[1]
+        for server in await self.get_servers():
+            start = time.monotonic()
+            try:
+                async with get_session().get(
+                    f"{server}/search",
+                    params={
+                        "q": query,
+                        "language": "en",
+                        "safesearch": 1,
+                        "format": "json",
+                    },
+                    timeout=aiohttp.ClientTimeout(total=SEARXNG_TIMEOUT),
+                ) as response:
+                    results = await response.json(content_type=None)
+                summaries = [
+                    result["title"] + " - " + result["url"]
+                    for result in results["results"]
+                ]
+            except Exception as e:
+                # The SearXNG server is down or refusing connection, try the next one.
+                logging.info(f"SearXNG instance {server} failed: {e}")
+                record_failure(server)
+                continue
+            record_success(server, time.monotonic() - start)
+            _results[key] = (time.time(), summaries)
+            while len(_results) > SEARXNG_RESULTS_CACHE_SIZE:
+                _results.popitem(last=False)
             return summaries
-        except:
-            # The SearXNG server is down or refusing connection, so we will use the default one.
-            self.SEARXNG_ENDPOINT = "https://search.us.projectsegfau.lt/search"
-            return await self.search(query)
+        return []
@@ -4,6 +4,29 @@ import pkg_resources
 import glob
 import os
 import inspect
+import asyncio
+import threading
+import time
+import gc
+import json
+import random
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha256
+from Tokens import count_tokens
+
+PROVIDER_CACHE_SIZE = int(os.getenv("PROVIDER_CACHE_SIZE", 32))
+PROVIDER_MAX_CONCURRENCY = int(os.getenv("PROVIDER_MAX_CONCURRENCY", 4))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 30))
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", 5))
+CIRCUIT_BREAKER_COOLDOWN = float(os.getenv("CIRCUIT_BREAKER_COOLDOWN", 60))
+_providers = OrderedDict()
+_providers_lock = threading.Lock()
+_installed_packages = None
+_checked_requirements = set()
 
 
 def get_providers():
@@ -28,12 +51,150 @@ def get_provider_options(provider_name):
     return options
 
 
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_retryable(error: Exception):
+    # Rate limits, timeouts, dropped connections and server errors are worth
+    # another try, bad requests, auth failures and bugs are not
+    status = None
+    for attr in ["status", "http_status", "status_code"]:
+        if isinstance(getattr(error, attr, None), int):
+            status = getattr(error, attr)
+            break
+    if status is not None:
+        return status in [408, 409, 425, 429] or status >= 500
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__
+    if any(word in name for word in ["Authentication", "Permission", "InvalidRequest"]):
+        return False
+    return not isinstance(
+        error, (ValueError, TypeError, AttributeError, KeyError, ImportError)
+    )
+
+
+def is_context_length_error(error: Exception):
+    # Prompts too long for the model are refused, but a retry with less context
+    # can succeed
+    message = str(error).lower()
+    return any(
+        phrase in message
+        for phrase in [
+            "context length",
+            "context_length",
+            "maximum context",
+            "too many tokens",
+            "prompt is too long",
+        ]
+    )
+
+
+class CircuitBreaker:
+    # Stops calling a provider after threshold retryable failures in a row. Once
+    # the cooldown has passed a single trial request is let through, the others
+    # are refused until it succeeds or opens the circuit again.
+    def __init__(
+        self,
+        threshold: int = CIRCUIT_BREAKER_THRESHOLD,
+        cooldown: float = CIRCUIT_BREAKER_COOLDOWN,
+    ):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.trial = True
+        return True
+
+    def release(self):
+        # The trial request was cancelled before it finished, let another through
+        self.trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self, error: Exception):
+        if not is_retryable(error):
+            # The provider answered and refused this one request, that only says
+            # something about its health when it was the trial request
+            if self.trial:
+                self.record_success()
+            return
+        self.trial = False
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt: int):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def call(self, func, circuit_breaker: CircuitBreaker = None, name=""):
+        for attempt in range(self.max_attempts):
+            if circuit_breaker is not None and not circuit_breaker.allow():
+                raise CircuitOpenError(f"{name} is failing, not calling it for now.")
+            try:
+                result = await func()
+            except Exception as e:
+                if circuit_breaker is not None:
+                    circuit_breaker.record_failure(e)
+                if attempt + 1 >= self.max_attempts or not is_retryable(e):
+                    raise
+                delay = self.get_delay(attempt)
+                logging.info(f"{name} failed with {e}, retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                if circuit_breaker is not None:
+                    circuit_breaker.release()
+                raise
+            if circuit_breaker is not None:
+                circuit_breaker.record_success()
+            return result
+
+
 class Provider:
     def __init__(self, name, **kwargs):
         try:
             module = importlib.import_module(f"provider.{name}")
             provider_class = getattr(module, f"{name.capitalize()}Provider")
+            self.name = name
             self.instance = provider_class(**kwargs)
+            # Requests allowed in flight at once, local models that batch requests
+            # set MAX_CONCURRENCY to the batch size
+            self.MAX_CONCURRENCY = int(
+                kwargs.get(
+                    "MAX_CONCURRENCY",
+                    getattr(self.instance, "MAX_CONCURRENCY", PROVIDER_MAX_CONCURRENCY),
+                )
+            )
+            self.semaphore = asyncio.Semaphore(max(1, self.MAX_CONCURRENCY))
+            self.retry_policy = RetryPolicy(
+                max_attempts=int(kwargs.get("RETRY_MAX_ATTEMPTS", RETRY_MAX_ATTEMPTS))
+            )
+            self.circuit_breaker = CircuitBreaker()
 
             # Install the requirements if any
             self.install_requirements()
@@ -44,6 +205,50 @@ class Provider:
     def __getattr__(self, attr):
         return getattr(self.instance, attr)
 
+    def count_tokens(self, text: str):
+        # Providers can define count_tokens with the model's own tokenizer
+        counter = getattr(self.instance, "count_tokens", None)
+        # Local models take their tokenizer from MODEL_PATH, not AI_MODEL
+        counter_name = f"{self.name}:{getattr(self.instance, 'AI_MODEL', '')}"
+        model_path = getattr(self.instance, "MODEL_PATH", "")
+        if model_path:
+            counter_name = f"{counter_name}:{model_path}"
+        return count_tokens(text, counter=counter, counter_name=counter_name)
+
+    async def instruct(self, prompt, tokens: int = 0):
+        async def attempt():
+            async with self.semaphore:
+                return await self.instance.instruct(prompt=prompt, tokens=tokens)
+
+        return await self.retry_policy.call(
+            attempt, circuit_breaker=self.circuit_breaker, name=self.name
+        )
+
+    async def instruct_stream(self, prompt, tokens: int = 0):
+        if not hasattr(self.instance, "instruct_stream"):
+            # Providers without streaming support yield the whole response at once
+            response = await self.instruct(prompt=prompt, tokens=tokens)
+            if response:
+                yield response
+            return
+        # Chunks already sent can't be taken back, so streams are not retried
+        if not self.circuit_breaker.allow():
+            raise CircuitOpenError(f"{self.name} is failing, not calling it for now.")
+        async with self.semaphore:
+            try:
+                async for chunk in self.instance.instruct_stream(
+                    prompt=prompt, tokens=tokens
+                ):
+                    yield chunk
+            except Exception as e:
+                self.circuit_breaker.record_failure(e)
+                raise
+            except BaseException:
+                # Cancelled or closed before the end of the stream
+                self.circuit_breaker.release()
+                raise
+        self.circuit_breaker.record_success()
+
     def get_providers(self):
         providers = []
         for provider in glob.glob("provider/*.py"):
@@ -52,11 +257,218 @@ class Provider:
         return providers
 
     def install_requirements(self):
+        # Requirements are checked once per provider per process, against a
+        # single snapshot of the installed packages
+        global _installed_packages
+        if self.name in _checked_requirements:
+            return
         requirements = getattr(self.instance, "requirements", [])
-        installed_packages = {pkg.key: pkg.version for pkg in pkg_resources.working_set}
+        if requirements and _installed_packages is None:
+            _installed_packages = {
+                pkg.key: pkg.version for pkg in pkg_resources.working_set
+            }
         for requirement in requirements:
-            if requirement.lower() not in installed_packages:
+            if requirement.lower() not in _installed_packages:
                 subprocess.run(["pip", "install", requirement], check=True)
+                _installed_packages[requirement.lower()] = None
+        _checked_requirements.add(self.name)
+
+
+def get_provider_key(name, settings):
+    settings = json.dumps(settings, sort_keys=True, default=str)
+    return name, sha256(settings.encode()).hexdigest()
+
+
+def get_provider(name, **kwargs):
+    # Constructed providers are shared between agents with identical settings,
+    # a settings change produces a new key and the old instance ages out
+    key = get_provider_key(name, kwargs)
+    with _providers_lock:
+        if key in _providers:
+            _providers.move_to_end(key)
+            return _providers[key]
+    provider = Provider(name, **kwargs)
+    with _providers_lock:
+        provider = _providers.setdefault(key, provider)
+        _providers.move_to_end(key)
+        while len(_providers) > PROVIDER_CACHE_SIZE:
+            _providers.popitem(last=False)
+    return provider
+
+
+def invalidate_provider(name, **kwargs):
+    with _providers_lock:
+        _providers.pop(get_provider_key(name, kwargs), None)
+
+
+async def iterate_in_thread(iterator):
+    # Consume a blocking iterator in a worker thread without blocking the event loop
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def worker():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    threading.Thread(target=worker, daemon=True).start()
+    while True:
+        item = await queue.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+MODEL_CACHE_TTL = float(os.getenv("MODEL_CACHE_TTL", 900))
+
+
+class ModelCache:
+    # Keeps local models resident between requests, one user at a time per model
+    def __init__(self, ttl: float = MODEL_CACHE_TTL, max_bytes: int = 0):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.models = {}
+        self.lock = threading.Lock()
+        self.janitor = None
+
+    @contextmanager
+    def use(self, key, loader, sizer=None):
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = {
+                    "model": None,
+                    "lock": threading.Lock(),
+                    "last_used": time.time(),
+                    "size": 0,
+                }
+            entry = self.models[key]
+            self.start_janitor()
+        with entry["lock"]:
+            if entry["model"] is None:
+                logging.info(f"Loading model {key}")
+                entry["model"] = loader()
+                entry["size"] = sizer(entry["model"]) if sizer else 0
+                entry["last_used"] = time.time()
+                self.enforce_budget(keep=key)
+            try:
+                yield entry["model"]
+            finally:
+                entry["last_used"] = time.time()
+
+    def enforce_budget(self, keep=None):
+        # Unload least recently used models until the loaded ones fit the budget
+        if not self.max_bytes:
+            return
+        entries = sorted(self.models.items(), key=lambda item: item[1]["last_used"])
+        total = sum(entry["size"] for _, entry in entries)
+        for key, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if key != keep and entry["model"] is not None and self.unload(key):
+                total -= entry["size"]
+
+    def unload(self, key):
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is None or not entry["lock"].acquire(blocking=False):
+                return False
+            try:
+                del self.models[key]
+                entry["model"] = None
+            finally:
+                entry["lock"].release()
+        gc.collect()
+        logging.info(f"Unloaded model {key}")
+        return True
+
+    def unload_idle(self):
+        now = time.time()
+        for key, entry in list(self.models.items()):
+            if now - entry["last_used"] >= self.ttl:
+                self.unload(key)
+
+    def start_janitor(self):
+        if self.janitor is None or not self.janitor.is_alive():
+            self.janitor = threading.Thread(target=self.run_janitor, daemon=True)
+            self.janitor.start()
+
+    def run_janitor(self):
+        while self.models:
+            time.sleep(min(self.ttl, 60))
+            self.unload_idle()
+
+
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW_MS", 50)) / 1000
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))
+
+
+class BatchQueue:
+    # Collects concurrent requests for one model within a short window and runs
+    # them together in a worker thread. runner maps a list of requests to a list of
+    # results, a result may be an exception to fail only that request
+    def __init__(self, runner, window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE):
+        self.runner = runner
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.loop = asyncio.get_running_loop()
+        self.pending = []
+        self.timer = None
+
+    async def submit(self, request):
+        future = self.loop.create_future()
+        self.pending.append((request, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending[: self.max_batch_size]
+        self.pending = self.pending[self.max_batch_size :]
+        if self.pending:
+            self.timer = self.loop.call_later(self.window, self.flush)
+        if batch:
+            self.loop.create_task(self.run(batch))
+
+    async def run(self, batch):
+        try:
+            results = await asyncio.to_thread(
+                self.runner, [request for request, _ in batch]
+            )
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+_batch_queues = {}
+
+
+def get_batch_queue(key, runner):
+    loop = asyncio.get_running_loop()
+    queue = _batch_queues.get(key)
+    if queue is None or queue.loop is not loop:
+        queue = BatchQueue(runner)
+        _batch_queues[key] = queue
+    return queue
 
 
 def __getattr__(name):
@@ -1,7 +1,5 @@
-from time import time
-from openai.error import RateLimitError
 import openai
-import logging
+from Tokens import get_tiktoken_counter
 
 
 class AzureProvider:
@@ -17,10 +15,9 @@ class AzureProvider:
         MAX_TOKENS: int = 4096,
         **kwargs,
     ):
-        openai.api_type = "azure"
-        openai.api_base = AZURE_OPENAI_ENDPOINT
-        openai.api_version = "2023-05-15"
-        openai.api_key = AZURE_API_KEY
+        # Passed on every request, the openai module globals are shared by every
+        # cached provider instance
+        self.AZURE_OPENAI_ENDPOINT = AZURE_OPENAI_ENDPOINT
         self.requirements = ["openai"]
         self.DEPLOYMENT_ID = DEPLOYMENT_ID
         self.AZURE_API_KEY = AZURE_API_KEY
@@ -30,21 +27,24 @@ class AzureProvider:
         self.MAX_TOKENS = MAX_TOKENS
         self.AZURE_EMBEDDER_DEPLOYMENT_ID = AZURE_EMBEDDER_DEPLOYMENT_ID
 
+    def count_tokens(self, text: str) -> int:
+        counter = get_tiktoken_counter(self.AI_MODEL)
+        if counter is None:
+            raise ImportError("tiktoken is not installed.")
+        return counter(text)
+
     async def instruct(self, prompt: str, tokens: int = 0) -> str:
-        num_retries = 3
+        # Rate limits are retried with backoff by the shared provider retry policy
         messages = [{"role": "system", "content": prompt}]
-        for _ in range(num_retries):
-            try:
-                resp = openai.ChatCompletion.create(
-                    engine=self.AI_MODEL,
-                    messages=messages,
-                    max_tokens=int(self.MAX_TOKENS),
-                    temperature=float(self.AI_TEMPERATURE),
-                    top_p=float(self.AI_TOP_P),
-                )["choices"][0]["message"]["content"]
-                return resp
-
-            except RateLimitError:
-                logging.info("Rate limit exceeded. Retrying after 20 seconds.")
-                time.sleep(20)
-                continue
+        response = await openai.ChatCompletion.acreate(
+            api_key=self.AZURE_API_KEY,
+            api_base=self.AZURE_OPENAI_ENDPOINT,
+            api_type="azure",
+            api_version="2023-05-15",
+            engine=self.AI_MODEL,
+            messages=messages,
+            max_tokens=int(self.MAX_TOKENS),
+            temperature=float(self.AI_TEMPERATURE),
+            top_p=float(self.AI_TOP_P),
+        )
+        return response["choices"][0]["message"]["content"]
@@ -1,5 +1,5 @@
-import requests
 import json
+from HttpClient import get_session
 
 
 class FastchatProvider:
@@ -18,8 +18,9 @@ class FastchatProvider:
     async def instruct(self, prompt, tokens: int = 0):
         messages = [{"role": "system", "content": prompt}]
         params = {"model": self.MODEL_PATH, "messages": messages}
-        response = requests.post(
+        async with get_session().post(
             f"{self.AI_PROVIDER_URI}/v1/chat/completions",
             json={"data": [json.dumps([prompt, params])]},
-        )
-        return response.json()["data"][0].replace("\n", "\n")
+        ) as response:
+            data = await response.json()
+        return data["data"][0].replace("\n", "\n")
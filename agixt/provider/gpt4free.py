@@ -1,5 +1,4 @@
 import gpt4free
-import time
 import logging
 import importlib
 import sys
@@ -47,66 +46,61 @@ class Gpt4freeProvider:
             logging.info(f"[GPT4Free] Failed provider: {provider}")
             if len(self.FAILED_PROVIDERS) == len(self.providers):
                 self.FAILED_PROVIDERS = []
-                logging.info(
-                    "All providers failed, sleeping for 10 seconds before trying again..."
-                )
-                time.sleep(10)
+                logging.info("[GPT4Free] All providers failed.")
 
     async def instruct(self, prompt, tokens: int = 0):
-        while True:
-            for provider in self.providers:
-                try:
-                    if provider not in self.FAILED_PROVIDERS:
-                        logging.info(f"[GPT4Free] Using: {provider}")
-                        if provider not in self.account_tokens:
-                            try:
-                                if provider == "Poe":
-                                    module_name = "quora"
-                                elif provider == "UseLess":
-                                    module_name = "usesless"
-                                else:
-                                    module_name = provider.lower()
-                                module = importlib.import_module(
-                                    "gpt4free.%s" % module_name
-                                )
-                                if module and hasattr(module, "Account"):
-                                    logging.info(f"Create account for: {provider}")
-                                    self.account_tokens[provider] = self.create_account(
-                                        provider, module
-                                    )
-                            except ModuleNotFoundError:
-                                self.account_tokens[provider] = None
-                        args = {}
-                        if provider in self.account_tokens:
-                            if provider == "ForeFront":
-                                args["account_data"] = self.account_tokens[provider]
+        for provider in self.providers:
+            try:
+                if provider not in self.FAILED_PROVIDERS:
+                    logging.info(f"[GPT4Free] Using: {provider}")
+                    if provider not in self.account_tokens:
+                        try:
+                            if provider == "Poe":
+                                module_name = "quora"
                             elif provider == "UseLess":
-                                args["token"] = self.account_tokens[provider]
-                            elif provider == "Poe":
-                                args["token"] = self.account_tokens[provider]
-                                args["model"] = "GPT-4"
+                                module_name = "usesless"
+                            else:
+                                module_name = provider.lower()
+                            module = importlib.import_module(
+                                "gpt4free.%s" % module_name
+                            )
+                            if module and hasattr(module, "Account"):
+                                logging.info(f"Create account for: {provider}")
+                                self.account_tokens[provider] = self.create_account(
+                                    provider, module
+                                )
+                        except ModuleNotFoundError:
+                            self.account_tokens[provider] = None
+                    args = {}
+                    if provider in self.account_tokens:
+                        if provider == "ForeFront":
+                            args["account_data"] = self.account_tokens[provider]
+                        elif provider == "UseLess":
+                            args["token"] = self.account_tokens[provider]
+                        elif provider == "Poe":
+                            args["token"] = self.account_tokens[provider]
+                            args["model"] = "GPT-4"
 
-                        response = gpt4free.Completion.create(
-                            getattr(gpt4free.Provider, provider), prompt=prompt, **args
-                        )
-                        if response:
-                            if provider == "UseLess":
-                                if "text" in response:
-                                    response = response["text"]
-                                if (
-                                    "status" in response
-                                    and response["status"] == "Fail"
-                                ):
-                                    response = None
-                            if (
-                                response
-                                == "Unable to fetch the response, Please try again."
-                            ):
+                    response = gpt4free.Completion.create(
+                        getattr(gpt4free.Provider, provider), prompt=prompt, **args
+                    )
+                    if response:
+                        if provider == "UseLess":
+                            if "text" in response:
+                                response = response["text"]
+                            if "status" in response and response["status"] == "Fail":
                                 response = None
-                        if response and len(response) > 1:
-                            return response
-                        else:
-                            await self.provider_failure(provider)
-                except Exception as e:
-                    logging.info(f"[GPT4Free] Exception: {e}")
-                    await self.provider_failure(provider)
+                        if (
+                            response
+                            == "Unable to fetch the response, Please try again."
+                        ):
+                            response = None
+                    if response and len(response) > 1:
+                        return response
+                    else:
+                        await self.provider_failure(provider)
+            except Exception as e:
+                logging.info(f"[GPT4Free] Exception: {e}")
+                await self.provider_failure(provider)
+        # Every provider failed this round, leave the retry to the caller's policy
+        raise Exception("[GPT4Free] All providers failed.")
@@ -1,6 +1,4 @@
-from time import time
-import requests
-import logging
+from HttpClient import get_session
 
 
 class HuggingfaceProvider:
@@ -20,24 +18,18 @@ class HuggingfaceProvider:
         self.MAX_TOKENS = MAX_TOKENS
 
     async def instruct(self, prompt: str, tokens: int = 0) -> str:
-        num_retries = 3
         headers = {"Authorization": f"Bearer {self.HUGGINGFACE_API_KEY}"}
         payload = {
             "inputs": prompt,
             "max_tokens": int(self.MAX_TOKENS),
             "temperature": float(self.AI_TEMPERATURE),
         }
-        for _ in range(num_retries):
-            try:
-                response = requests.post(
-                    self.HUGGINGFACE_API_URL,
-                    headers=headers,
-                    json=payload,
-                )
-                response.raise_for_status()
-                return response.json()[0]["generated_text"]
-            except requests.exceptions.RequestException as e:
-                logging.error(e)
-                logging.info("Rate limit exceeded. Retrying after 20 seconds.")
-                time.sleep(20)
-                continue
+        # Rate limits are retried with backoff by the shared provider retry policy
+        async with get_session().post(
+            self.HUGGINGFACE_API_URL,
+            headers=headers,
+            json=payload,
+            raise_for_status=True,
+        ) as response:
+            data = await response.json()
+        return data[0]["generated_text"]
@@ -1,4 +1,5 @@
-import requests
+import json
+from HttpClient import get_session
 
 
 class KoboldProvider:
@@ -16,21 +17,43 @@ class KoboldProvider:
         self.AI_TEMPERATURE = AI_TEMPERATURE
         self.AI_MODEL = AI_MODEL
 
-    async def instruct(self, prompt, tokens: int = 0):
+    def get_params(self, prompt, tokens: int = 0):
         try:
             max_tokens = int(self.MAX_TOKENS - tokens)
         except:
             max_tokens = 2000
-        response = requests.post(
+        return {
+            "prompt": prompt,
+            "max_context_length": max_tokens,
+            "max_length": 200,
+            "temperature": float(self.AI_TEMPERATURE),
+        }
+
+    async def instruct(self, prompt, tokens: int = 0):
+        async with get_session().post(
             f"{self.AI_PROVIDER_URI}/api/v1/generate",
-            json={
-                "prompt": prompt,
-                "max_context_length": max_tokens,
-                "max_length": 200,
-                "temperature": float(self.AI_TEMPERATURE),
-            },
-        )
+            json=self.get_params(prompt=prompt, tokens=tokens),
+        ) as response:
+            data = await response.json()
         try:
-            return response.json()["results"][0]["text"].replace("\n", "\n")
+            return data["results"][0]["text"].replace("\n", "\n")
         except:
-            return response.json()["detail"][0]["msg"].replace("\n", "\n")
+            return data["detail"][0]["msg"].replace("\n", "\n")
+
+    async def instruct_stream(self, prompt, tokens: int = 0):
+        # KoboldCpp streams tokens as server-sent events, KoboldAI does not
+        async with get_session().post(
+            f"{self.AI_PROVIDER_URI}/api/extra/generate/stream",
+            json=self.get_params(prompt=prompt, tokens=tokens),
+        ) as response:
+            if response.status != 200:
+                text = await self.instruct(prompt=prompt, tokens=tokens)
+                if text:
+                    yield text
+                return
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    token = json.loads(line[5:]).get("token")
+                    if token:
+                        yield token
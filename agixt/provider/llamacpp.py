@@ -3,12 +3,27 @@ import sys
 import os
 import logging
 import random
+from provider import MAX_BATCH_SIZE, ModelCache, get_batch_queue, iterate_in_thread
 
 try:
-    from llama_cpp import Llama
+    from llama_cpp import Llama, LlamaCache
 except:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "llama-cpp-python"])
-    from llama_cpp import Llama
+    from llama_cpp import Llama, LlamaCache
+
+models = ModelCache()
+
+
+_tokenizers = {}
+
+
+def load_tokenizer(model_path: str):
+    # A vocab-only model is enough to tokenize and skips loading the weights
+    if model_path not in _tokenizers:
+        _tokenizers[model_path] = Llama(
+            model_path=model_path, vocab_only=True, verbose=False
+        )
+    return _tokenizers[model_path]
 
 
 class LlamacppProvider:
@@ -25,6 +40,7 @@ class LlamacppProvider:
         **kwargs,
     ):
         self.requirements = ["llama-cpp-python"]
+        self.MAX_CONCURRENCY = MAX_BATCH_SIZE
         self.AI_TEMPERATURE = AI_TEMPERATURE
         self.MAX_TOKENS = MAX_TOKENS
         self.AI_MODEL = AI_MODEL
@@ -39,30 +55,73 @@ class LlamacppProvider:
             except:
                 self.MAX_TOKENS = 2048
 
+    def count_tokens(self, text: str) -> int:
+        tokenizer = load_tokenizer(self.MODEL_PATH)
+        return len(tokenizer.tokenize(text.encode("utf-8")))
+
+    def get_model_key(self):
+        return (
+            self.MODEL_PATH,
+            int(self.MAX_TOKENS),
+            int(self.GPU_LAYERS),
+            int(self.THREADS) if self.THREADS else None,
+            int(self.BATCH_SIZE),
+        )
+
+    def load_model(self):
+        model = Llama(
+            model_path=self.MODEL_PATH,
+            n_gpu_layers=int(self.GPU_LAYERS),
+            n_threads=int(self.THREADS) if self.THREADS else None,
+            n_batch=int(self.BATCH_SIZE),
+            n_ctx=int(self.MAX_TOKENS),
+            seed=random.randint(1, 1000000000),
+        )
+        # Keep evaluated prompt state around so shared prompt prefixes are reused
+        model.set_cache(LlamaCache())
+        return model
+
+    def generate_batch(self, prompts):
+        # llama.cpp evaluates one sequence at a time, so run the batch back to back
+        # under one model lock, ordered so prompts sharing a prefix reuse the cache
+        results = [None] * len(prompts)
+        with models.use(self.get_model_key(), self.load_model) as model:
+            for i in sorted(range(len(prompts)), key=lambda i: prompts[i]):
+                try:
+                    response = model(
+                        prompts[i],
+                        stop=[self.STOP_SEQUENCE],
+                        temperature=float(self.AI_TEMPERATURE),
+                    )
+                    results[i] = response["choices"][0]["text"].lstrip("\n")
+                except Exception as e:
+                    results[i] = e
+        return results
+
+    def generate_stream(self, prompt):
+        with models.use(self.get_model_key(), self.load_model) as model:
+            for chunk in model(
+                prompt,
+                stop=[self.STOP_SEQUENCE],
+                temperature=float(self.AI_TEMPERATURE),
+                stream=True,
+            ):
+                yield chunk["choices"][0]["text"]
+
     async def instruct(self, prompt, tokens: int = 0):
-        if os.path.isfile(self.MODEL_PATH):
-            self.model = Llama(
-                model_path=self.MODEL_PATH,
-                n_gpu_layers=int(self.GPU_LAYERS),
-                n_threads=int(self.THREADS),
-                n_batch=int(self.BATCH_SIZE),
-                n_ctx=int(self.MAX_TOKENS),
-                seed=random.randint(1, 1000000000),
-            )
-        else:
+        if not os.path.isfile(self.MODEL_PATH):
             logging.info("Unable to find model path.")
             return None
-        response = self.model(
-            prompt,
-            stop=[self.STOP_SEQUENCE],
-            temperature=float(self.AI_TEMPERATURE),
-            echo=True,
+        queue = get_batch_queue(
+            ("llamacpp", self.get_model_key(), self.AI_TEMPERATURE, self.STOP_SEQUENCE),
+            self.generate_batch,
         )
-        data = response["choices"][0]["text"]
-        data = data.replace(prompt, "")
-        data = data.lstrip("\n")
-        try:
-            self.model.reset()
-        except:
-            print("Unable to reset model.")
-        return data
+        return await queue.submit(prompt)
+
+    async def instruct_stream(self, prompt, tokens: int = 0):
+        if not os.path.isfile(self.MODEL_PATH):
+            logging.info("Unable to find model path.")
+            return
+        async for text in iterate_in_thread(self.generate_stream(prompt)):
+            if text:
+                yield text
@@ -1,5 +1,5 @@
-import requests
 import random
+from HttpClient import get_session
 
 
 class LlamacppapiProvider:
@@ -19,16 +19,17 @@ class LlamacppapiProvider:
         self.STOP_SEQUENCE = STOP_SEQUENCE
         self.MAX_TOKENS = int(self.MAX_TOKENS)
 
-    def instruct(self, prompt, tokens: int = 0):
+    async def instruct(self, prompt, tokens: int = 0):
         params = {
             "prompt": prompt,
             "temperature": float(self.AI_TEMPERATURE),
             "stop": self.STOP_SEQUENCE,
             "seed": random.randint(1, 1000000000),
         }
-        response = requests.post(f"{self.AI_PROVIDER_URI}/v1/completions", json=params)
-        data = response.json()
-        print(data)
+        async with get_session().post(
+            f"{self.AI_PROVIDER_URI}/v1/completions", json=params
+        ) as response:
+            data = await response.json()
         choices = data["choices"]
         if choices:
             return choices[0]["text"]
@@ -1,6 +1,7 @@
-import requests
 import random
+import json
 import re
+from HttpClient import get_session
 
 
 class OobaboogaProvider:
@@ -10,17 +11,19 @@ class OobaboogaProvider:
         MAX_TOKENS: int = 2048,
         AI_TEMPERATURE: float = 0.7,
         AI_MODEL: str = "default",
+        AI_PROVIDER_STREAMING_URI: str = "",
         **kwargs,
     ):
         self.AI_PROVIDER_URI = AI_PROVIDER_URI
+        self.AI_PROVIDER_STREAMING_URI = AI_PROVIDER_STREAMING_URI
         self.MAX_TOKENS = MAX_TOKENS
         self.AI_TEMPERATURE = AI_TEMPERATURE
         self.AI_MODEL = AI_MODEL
         self.requirements = []
 
-    async def instruct(self, prompt, tokens: int = 0):
+    def get_params(self, prompt, tokens: int = 0):
         new_tokens = int(self.MAX_TOKENS) - tokens
-        params = {
+        return {
             "prompt": prompt,
             "max_new_tokens": new_tokens,
             "do_sample": True,
@@ -42,9 +45,33 @@ class OobaboogaProvider:
             "skip_special_tokens": True,
             "stopping_strings": [],
         }
-        response = requests.post(f"{self.AI_PROVIDER_URI}/api/v1/generate", json=params)
+
+    async def instruct(self, prompt, tokens: int = 0):
+        params = self.get_params(prompt=prompt, tokens=tokens)
         data = None
-        if response.status_code == 200:
-            data = response.json()["results"][0]["text"]
-            data = re.sub(r"(?<!\\)\\(?!n)", "", data)
+        async with get_session().post(
+            f"{self.AI_PROVIDER_URI}/api/v1/generate", json=params
+        ) as response:
+            if response.status == 200:
+                data = (await response.json())["results"][0]["text"]
+                data = re.sub(r"(?<!\\)\\(?!n)", "", data)
         return data
+
+    async def instruct_stream(self, prompt, tokens: int = 0):
+        # The streaming API is served over a websocket, usually on port 5005
+        if not self.AI_PROVIDER_STREAMING_URI:
+            response = await self.instruct(prompt=prompt, tokens=tokens)
+            if response:
+                yield response
+            return
+        params = self.get_params(prompt=prompt, tokens=tokens)
+        async with get_session().ws_connect(
+            f"{self.AI_PROVIDER_STREAMING_URI}/api/v1/stream"
+        ) as websocket:
+            await websocket.send_json(params)
+            async for message in websocket:
+                data = json.loads(message.data)
+                if data["event"] == "text_stream":
+                    yield re.sub(r"(?<!\\)\\(?!n)", "", data["text"])
+                elif data["event"] == "stream_end":
+                    break
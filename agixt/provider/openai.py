@@ -1,4 +1,5 @@
 import openai
+from Tokens import get_tiktoken_counter
 
 
 class OpenaiProvider:
@@ -16,13 +17,22 @@ class OpenaiProvider:
         self.AI_TEMPERATURE = AI_TEMPERATURE
         self.AI_TOP_P = AI_TOP_P
         self.MAX_TOKENS = MAX_TOKENS
-        openai.api_key = OPENAI_API_KEY
+        # Passed on every request, the openai module globals are shared by every
+        # cached provider instance
+        self.OPENAI_API_KEY = OPENAI_API_KEY
+
+    def count_tokens(self, text: str) -> int:
+        counter = get_tiktoken_counter(self.AI_MODEL)
+        if counter is None:
+            raise ImportError("tiktoken is not installed.")
+        return counter(text)
 
     async def instruct(self, prompt, tokens: int = 0):
         max_new_tokens = int(self.MAX_TOKENS) - tokens
         if not self.AI_MODEL.startswith("gpt-"):
             # Use completion API
             response = openai.Completion.create(
+                api_key=self.OPENAI_API_KEY,
                 engine=self.AI_MODEL,
                 prompt=prompt,
                 temperature=float(self.AI_TEMPERATURE),
@@ -36,6 +46,7 @@ class OpenaiProvider:
             # Use chat completion API
             messages = [{"role": "system", "content": prompt}]
             response = openai.ChatCompletion.create(
+                api_key=self.OPENAI_API_KEY,
                 model=self.AI_MODEL,
                 messages=messages,
                 temperature=float(self.AI_TEMPERATURE),
@@ -45,3 +56,39 @@ class OpenaiProvider:
                 stop=None,
             )
             return response.choices[0].message.content.strip()
+
+    async def instruct_stream(self, prompt, tokens: int = 0):
+        max_new_tokens = int(self.MAX_TOKENS) - tokens
+        if not self.AI_MODEL.startswith("gpt-"):
+            response = await openai.Completion.acreate(
+                api_key=self.OPENAI_API_KEY,
+                engine=self.AI_MODEL,
+                prompt=prompt,
+                temperature=float(self.AI_TEMPERATURE),
+                max_tokens=max_new_tokens,
+                top_p=float(self.AI_TOP_P),
+                frequency_penalty=0,
+                presence_penalty=0,
+                stream=True,
+            )
+            async for chunk in response:
+                text = chunk.choices[0].text
+                if text:
+                    yield text
+        else:
+            messages = [{"role": "system", "content": prompt}]
+            response = await openai.ChatCompletion.acreate(
+                api_key=self.OPENAI_API_KEY,
+                model=self.AI_MODEL,
+                messages=messages,
+                temperature=float(self.AI_TEMPERATURE),
+                max_tokens=max_new_tokens,
+                top_p=float(self.AI_TOP_P),
+                n=1,
+                stop=None,
+                stream=True,
+            )
+            async for chunk in response:
+                content = chunk.choices[0].delta.get("content")
+                if content:
+                    yield content
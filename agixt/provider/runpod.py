@@ -1,28 +1,7 @@
-from threading import Thread
-from concurrent.futures import Future
+import asyncio
 import logging
-import time
 import random
-
-
-def call_with_future(fn, future, args, kwargs):
-    try:
-        result = fn(*args, **kwargs)
-        future.set_result(result)
-    except Exception as exc:
-        future.set_exception(exc)
-
-
-def threaded(fn):
-    def wrapper(*args, **kwargs):
-        future = Future()
-        Thread(target=call_with_future, args=(fn, future, args, kwargs)).start()
-        return future
-
-    return wrapper
-
-
-import requests
+from HttpClient import get_session
 
 
 class RunpodProvider:
@@ -42,14 +21,13 @@ class RunpodProvider:
         self.AI_MODEL = AI_MODEL
         self.API_KEY = API_KEY
 
-    @threaded
     async def instruct(self, prompt, tokens: int = 0):
         headers = {"Authorization": f"Bearer {self.API_KEY}"}
         max_new_tokens = int(self.MAX_TOKENS) - tokens
 
         logging.info("Instructing Agent with %s", prompt)
 
-        run_response = requests.post(
+        async with get_session().post(
             f"{self.AI_PROVIDER_URI}/run",
             headers=headers,
             json={
@@ -78,16 +56,18 @@ class RunpodProvider:
                     "stopping_strings": [],
                 },
             },
-        )
-        logging.info("Run Response: %s", run_response.json())
-        jobId = run_response.json()["id"]
+        ) as run_response:
+            run_data = await run_response.json()
+        logging.info("Run Response: %s", run_data)
+        jobId = run_data["id"]
         logging.info("Job ID: %s", jobId)
         while True:
             status_url = f"{self.AI_PROVIDER_URI}/status/{jobId}"
             logging.info("Requesting status url: %s", status_url)
-            status_response = requests.get(status_url, headers=headers)
-            logging.info("Status Response: %s", status_response.json())
-            status = status_response.json()["status"]
+            async with get_session().get(status_url, headers=headers) as response:
+                status_data = await response.json()
+            logging.info("Status Response: %s", status_data)
+            status = status_data["status"]
             logging.info("Status: %s", status)
             # IN_QUEUE, RUNNING, COMPLETED, FAILED
             if status == "COMPLETED":
@@ -97,7 +77,7 @@ class RunpodProvider:
                 #     f"{self.AI_PROVIDER_URI}/status/{jobId}", headers=headers
                 # )
                 # logging.info("Result: %s", result_response.json())
-                output = status_response.json()["output"]
+                output = status_data["output"]
                 logging.info("Output: %s", output)
                 return output
             elif status == "FAILED":
@@ -105,4 +85,4 @@ class RunpodProvider:
                 return None
             else:
                 logging.info("Sleeping for 2")
-                time.sleep(2)
+                await asyncio.sleep(2)
@@ -1,5 +1,9 @@
 import subprocess
 import sys
+import os
+import logging
+from threading import Thread
+from provider import MAX_BATCH_SIZE, ModelCache, get_batch_queue, iterate_in_thread
 
 try:
     from transformers import (
@@ -8,6 +12,7 @@ try:
         AutoModel,
         AutoModelForSeq2SeqLM,
         T5Tokenizer,
+        TextIteratorStreamer,
     )
 except ImportError:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "transformers"])
@@ -17,6 +22,64 @@ except ImportError:
         AutoModel,
         AutoModelForSeq2SeqLM,
         T5Tokenizer,
+        TextIteratorStreamer,
+    )
+
+
+_tokenizers = {}
+
+
+def load_tokenizer(model_path: str):
+    if model_path not in _tokenizers:
+        if "chatglm" in model_path:
+            tokenizer = AutoTokenizer.from_pretrained(
+                model_path, trust_remote_code=True
+            )
+        elif "dolly" in model_path:
+            tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+            # 50277 means "### End"
+            tokenizer.eos_token_id = 50277
+        elif "pythia" in model_path or "stablelm" in model_path:
+            tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+        elif "t5" in model_path:
+            tokenizer = T5Tokenizer.from_pretrained(model_path, use_fast=False)
+        else:
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+        _tokenizers[model_path] = tokenizer
+    return _tokenizers[model_path]
+
+
+# Memory budget for resident models in GB, 0 keeps every loaded model
+models = ModelCache(
+    max_bytes=int(float(os.getenv("TRANSFORMER_MEMORY_BUDGET_GB", 0)) * 1024**3)
+)
+
+
+def load_model(model_path: str, precision: str = "float32"):
+    import torch
+
+    kwargs = {"low_cpu_mem_usage": True}
+    if precision == "bfloat16":
+        kwargs["torch_dtype"] = torch.bfloat16
+    if "chatglm" in model_path:
+        model = AutoModel.from_pretrained(model_path, trust_remote_code=True)
+    elif "t5" in model_path:
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_path, **kwargs)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_path, **kwargs)
+    if precision == "int8":
+        # Dynamic int8 quantization of the linear layers for CPU inference
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    model.eval()
+    return model
+
+
+def get_model_size(model):
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for tensor in list(model.parameters()) + list(model.buffers())
     )
 
 
@@ -27,58 +90,139 @@ class TransformerProvider:
         AI_TEMPERATURE: float = 0.7,
         MAX_TOKENS: int = 4096,
         AI_MODEL: str = "starchat",
+        PRECISION: str = "float32",
         **kwargs,
     ):
         self.requirements = ["transformers", "accelerate"]
+        # Concurrent requests are batched, so let a full batch through
+        self.MAX_CONCURRENCY = MAX_BATCH_SIZE
         self.AI_MODEL = AI_MODEL
         self.AI_TEMPERATURE = AI_TEMPERATURE
         self.MAX_TOKENS = MAX_TOKENS
         self.MODEL_PATH = MODEL_PATH
+        self.PRECISION = PRECISION if PRECISION else "float32"
+
+    def count_tokens(self, text: str) -> int:
+        tokenizer = load_tokenizer(self.MODEL_PATH)
+        return len(tokenizer(text).input_ids)
+
+    def use_model(self):
+        return models.use(
+            (self.MODEL_PATH, self.PRECISION),
+            lambda: (
+                load_tokenizer(self.MODEL_PATH),
+                load_model(self.MODEL_PATH, self.PRECISION),
+            ),
+            sizer=lambda pair: get_model_size(pair[1]),
+        )
+
+    def generate(self, prompt, max_new_tokens, streamer=None):
+        with self.use_model() as (tokenizer, model):
+            return self.generate_with(
+                tokenizer, model, prompt, max_new_tokens, streamer=streamer
+            )
+
+    def generate_with(self, tokenizer, model, prompt, max_new_tokens, streamer=None):
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        output_ids = model.generate(
+            input_ids,
+            pad_token_id=tokenizer.eos_token_id,
+            temperature=self.AI_TEMPERATURE,
+            max_new_tokens=max_new_tokens,
+            no_repeat_ngram_size=2,
+            streamer=streamer,
+        )
+        input_length = 1 if model.config.is_encoder_decoder else len(input_ids[0])
+        output_ids = output_ids[0][input_length:]
+        return tokenizer.decode(output_ids, skip_special_tokens=True).strip()
+
+    def generate_padded(self, tokenizer, model, requests):
+        import torch
+
+        # Padded by hand, setting pad_token or padding_side would change the
+        # tokenizer shared with count_tokens and streaming
+        max_new_tokens = max(tokens for _, tokens in requests)
+        encoded = [tokenizer(prompt).input_ids for prompt, _ in requests]
+        pad_token_id = tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = tokenizer.eos_token_id
+        length = max(len(ids) for ids in encoded)
+        input_ids = []
+        attention_mask = []
+        for ids in encoded:
+            padding = length - len(ids)
+            if model.config.is_encoder_decoder:
+                input_ids.append(ids + [pad_token_id] * padding)
+                attention_mask.append([1] * len(ids) + [0] * padding)
+            else:
+                # Decoder-only models continue from the end, so pad on the left
+                input_ids.append([pad_token_id] * padding + ids)
+                attention_mask.append([0] * padding + [1] * len(ids))
+        inputs = {
+            "input_ids": torch.tensor(input_ids),
+            "attention_mask": torch.tensor(attention_mask),
+        }
+        output_ids = model.generate(
+            **inputs,
+            pad_token_id=pad_token_id,
+            temperature=self.AI_TEMPERATURE,
+            max_new_tokens=max_new_tokens,
+            no_repeat_ngram_size=2,
+        )
+        input_length = 1 if model.config.is_encoder_decoder else length
+        return [
+            tokenizer.decode(
+                output[input_length:][:tokens], skip_special_tokens=True
+            ).strip()
+            for output, (_, tokens) in zip(output_ids, requests)
+        ]
+
+    def generate_batch(self, requests):
+        with self.use_model() as (tokenizer, model):
+            if len(requests) > 1:
+                try:
+                    return self.generate_padded(tokenizer, model, requests)
+                except Exception as e:
+                    logging.info(f"Batched generation failed, running one by one: {e}")
+            results = []
+            for prompt, max_new_tokens in requests:
+                try:
+                    results.append(
+                        self.generate_with(tokenizer, model, prompt, max_new_tokens)
+                    )
+                except Exception as e:
+                    results.append(e)
+            return results
+
+    def generate_stream(self, prompt, max_new_tokens, streamer):
+        try:
+            self.generate(prompt, max_new_tokens, streamer)
+        except Exception as e:
+            logging.info(f"Transformer Error: {e}")
+            # Unblock the consumer waiting on the streamer
+            streamer.end()
 
     async def instruct(self, prompt, tokens: int = 0):
         max_new_tokens = int(self.MAX_TOKENS) - tokens
         try:
-            model_path = self.MODEL_PATH
-            if "chatglm" in model_path:
-                tokenizer = AutoTokenizer.from_pretrained(
-                    model_path, trust_remote_code=True
-                )
-                model = AutoModel.from_pretrained(model_path, trust_remote_code=True)
-            elif "dolly" in model_path:
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-                model = AutoModelForCausalLM.from_pretrained(
-                    model_path, low_cpu_mem_usage=True
-                )
-                # 50277 means "### End"
-                tokenizer.eos_token_id = 50277
-            elif "pythia" in model_path or "stablelm" in model_path:
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-                model = AutoModelForCausalLM.from_pretrained(
-                    model_path, low_cpu_mem_usage=True
-                )
-            elif "t5" in model_path:
-                tokenizer = T5Tokenizer.from_pretrained(model_path, use_fast=False)
-                model = AutoModelForSeq2SeqLM.from_pretrained(
-                    model_path, low_cpu_mem_usage=True
-                )
-            else:
-                tokenizer = AutoTokenizer.from_pretrained(model_path)
-                model = AutoModelForCausalLM.from_pretrained(
-                    model_path, low_cpu_mem_usage=True
-                )
-
-            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
-
-            output_ids = model.generate(
-                input_ids,
-                pad_token_id=tokenizer.eos_token_id,
-                temperature=self.AI_TEMPERATURE,
-                max_new_tokens=max_new_tokens,
-                no_repeat_ngram_size=2,
+            queue = get_batch_queue(
+                ("transformer", self.MODEL_PATH, self.PRECISION, self.AI_TEMPERATURE),
+                self.generate_batch,
             )
-            input_length = 1 if model.config.is_encoder_decoder else len(input_ids[0])
-            output_ids = output_ids[0][input_length:]
-
-            return tokenizer.decode(output_ids, skip_special_tokens=True).strip()
+            return await queue.submit((prompt, max_new_tokens))
         except Exception as e:
             return f"Transformer Error: {e}"
+
+    async def instruct_stream(self, prompt, tokens: int = 0):
+        max_new_tokens = int(self.MAX_TOKENS) - tokens
+        streamer = TextIteratorStreamer(
+            load_tokenizer(self.MODEL_PATH), skip_prompt=True, skip_special_tokens=True
+        )
+        Thread(
+            target=self.generate_stream,
+            args=(prompt, max_new_tokens, streamer),
+            daemon=True,
+        ).start()
+        async for text in iterate_in_thread(streamer):
+            if text:
+                yield text